@@ -0,0 +1,137 @@
+# Offline benchmark of disk_analysis.main against the local stand-in of the Azure APIs (benchmarks/stub_server.py)
+# Example usage (from the repository root):
+# python benchmarks/run_benchmark.py --fleet_sizes 1000,10000,100000 --latency_ms 20 --throttle_rate 0.01
+import os
+import sys
+import time
+import json
+import socket
+import argparse
+import tempfile
+import multiprocessing
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from benchmarks.stub_server import serve  # noqa: E402
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--fleet_sizes", type=str, default="1000,10000",
+                    help="Comma separated numbers of disks of the synthetic fleets. Default is 1000,10000.")
+parser.add_argument("--latency_ms", type=float, default=20,
+                    help="Latency added by the stub to every response. Default is 20.")
+parser.add_argument("--throttle_rate", type=float, default=0.01,
+                    help="Share of stub responses being 429 Too Many Requests. Default is 0.01.")
+parser.add_argument("--timerange_days_metrics", type=int, default=1,
+                    help="Number of days of metrics. Default is 1.")
+parser.add_argument("--interval_ISO_metrics", type=str, default="PT1H",
+                    help="Interval ISO of metrics, PT1M gives production sized payloads. Default is PT1H.")
+parser.add_argument("--max_workers_metrics", type=int, default=16,
+                    help="Number of concurrent metrics requests. Default is 16.")
+parser.add_argument("--batch_metrics", action="store_true",
+                    help="Benchmark the batch metrics API path.")
+parser.add_argument("--use_resource_graph", action="store_true",
+                    help="Benchmark the Azure Resource Graph inventory path.")
+parser.add_argument("--output", type=str, default="output/benchmark_results.json",
+                    help="Path of the JSON results. Default is output/benchmark_results.json.")
+
+
+class StubCredential:
+    # Stands in for DefaultAzureCredential, the stub does not check tokens
+    def get_token(self, *scopes, **kwargs):
+        from azure.core.credentials import AccessToken
+        return AccessToken("stub-token", int(time.time()) + 3600)
+
+
+def get_free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port: int, timeout: float = 60) -> None:
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise TimeoutError(f"Stub server did not start on port {port}")
+
+
+def get_throughputs(report: dict, n_disks: int) -> dict:
+    # Disks per second of every stage, and requests per second of the stages sending requests
+    stages = {}
+    for name, stage in report["stages"].items():
+        wall_time = stage["wall_time_seconds"]
+        stages[name] = {"wall_time_seconds": round(wall_time, 4),
+                        "disks_per_second": round(n_disks / wall_time, 1) if wall_time else None}
+    requests_by_stage = {"inventory": ["subscriptions", "inventory", "resource_graph"], "metrics": [
+        "metrics", "metrics_batch"], "pricing": ["prices"]}
+    for name, kinds in requests_by_stage.items():
+        if name in stages:
+            count = sum(report["requests"].get(kind, {}).get("count", 0) for kind in kinds)
+            stages[name]["requests"] = count
+            stages[name]["requests_per_second"] = round(
+                count / stages[name]["wall_time_seconds"], 1) if stages[name]["wall_time_seconds"] else None
+    return stages
+
+
+def run_fleet(args, port: int, n_disks: int) -> dict:
+    import disk_analysis
+    from modules.instrumentation import run_report
+    server = multiprocessing.Process(target=serve, kwargs={"port": port, "n_disks": n_disks, "latency_ms": args.latency_ms,
+                                                           "throttle_rate": args.throttle_rate}, daemon=True)
+    server.start()
+    cwd = os.getcwd()
+    try:
+        wait_for_port(port)
+        with tempfile.TemporaryDirectory() as run_dir:
+            # Fresh working directory so that no cache of a previous run is reused
+            os.chdir(run_dir)
+            analysis_args = ["--timerange_days_metrics", str(args.timerange_days_metrics), "--interval_ISO_metrics", args.interval_ISO_metrics,
+                             "--max_workers_metrics", str(args.max_workers_metrics)]
+            analysis_args += ["--batch_metrics"] if args.batch_metrics else []
+            analysis_args += ["--use_resource_graph"] if args.use_resource_graph else []
+            start = time.perf_counter()
+            disk_analysis.main(disk_analysis.parser.parse_args(
+                analysis_args), credential=StubCredential())
+            wall_time = time.perf_counter() - start
+            report = run_report.to_dict()
+    finally:
+        os.chdir(cwd)
+        server.terminate()
+        server.join()
+    return {
+        "n_disks": n_disks,
+        "wall_time_seconds": round(wall_time, 4),
+        "disks_per_second": round(n_disks / wall_time, 1),
+        "stages": get_throughputs(report, n_disks),
+        "report": report
+    }
+
+
+def main(args):
+    port = get_free_port()
+    # Endpoints are read when the modules are imported, so they are set before importing disk_analysis
+    os.environ["AZURE_MANAGEMENT_ENDPOINT"] = f"http://127.0.0.1:{port}"
+    os.environ["AZURE_METRICS_BATCH_ENDPOINT"] = f"http://127.0.0.1:{port}"
+    os.environ["AZURE_PRICES_ENDPOINT"] = f"http://127.0.0.1:{port}"
+    results = [run_fleet(args, port, int(n_disks))
+               for n_disks in args.fleet_sizes.split(",")]
+    print(f"{'disks':>8} {'stage':<16} {'seconds':>9} {'disks/s':>10} {'requests/s':>11}")
+    for result in results:
+        print(
+            f"{result['n_disks']:>8} {'end-to-end':<16} {result['wall_time_seconds']:>9} {result['disks_per_second']:>10} {'':>11}")
+        for name, stage in result["stages"].items():
+            print(
+                f"{'':>8} {name:<16} {stage['wall_time_seconds']:>9} {str(stage['disks_per_second']):>10} {str(stage.get('requests_per_second', '')):>11}")
+    Path(args.output).parent.mkdir(parents=True, exist_ok=True)
+    with open(args.output, "w") as f:
+        json.dump({"args": vars(args), "results": results}, f, indent=2)
+    print(f"Saved benchmark results to {args.output}.")
+
+
+if __name__ == "__main__":
+    main(parser.parse_args())
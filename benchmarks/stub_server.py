@@ -0,0 +1,233 @@
+# Local stand-in of the Azure ARM, Monitor and Retail Prices endpoints used by disk_analysis.py, serving a synthetic fleet of disks
+# Example usage:
+# python benchmarks/stub_server.py --n_disks 10000 --latency_ms 20 --throttle_rate 0.01
+import re
+import json
+import time
+import random
+import argparse
+import numpy as np
+from pathlib import Path
+from urllib.parse import urlsplit, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+REGIONS = ["westeurope", "northeurope", "eastus", "westus2"]
+SKU_NAMES = ["Standard_LRS", "StandardSSD_LRS", "Premium_LRS"]
+DISK_SIZES = [4, 32, 64, 100, 128, 256, 512, 1000, 1024, 2048, 4096]
+DISKS_PAGE_SIZE = 1000
+PRICES_PAGE_SIZE = 100
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--port", type=int, default=8765, help="Port to listen on. Default is 8765.")
+parser.add_argument("--n_disks", type=int, default=1000, help="Number of disks of the synthetic fleet. Default is 1000.")
+parser.add_argument("--disks_per_subscription", type=int, default=500,
+                    help="Number of disks per subscription. Default is 500.")
+parser.add_argument("--latency_ms", type=float, default=0, help="Latency added to every response. Default is 0.")
+parser.add_argument("--throttle_rate", type=float, default=0,
+                    help="Share of requests answered with 429 Too Many Requests, between 0 and 1. Default is 0.")
+parser.add_argument("--retry_after", type=int, default=0,
+                    help="Retry-After (seconds) sent with throttled responses. Default is 0.")
+
+
+class Fleet:
+    # Synthetic disks, deterministic for a given size so that runs are comparable
+    def __init__(self, n_disks: int, disks_per_subscription: int = 500):
+        rng = np.random.default_rng(n_disks)
+        n_subscriptions = max(1, -(-n_disks // disks_per_subscription))
+        self.subscription_ids = [
+            f"00000000-0000-0000-0000-{i:012d}" for i in range(n_subscriptions)]
+        self.disks_by_subscription = {subscription_id: []
+                                      for subscription_id in self.subscription_ids}
+        self.disks = []
+        for i, (sku_index, size_index) in enumerate(zip(rng.integers(0, len(SKU_NAMES), n_disks), rng.integers(0, len(DISK_SIZES), n_disks))):
+            subscription_id = self.subscription_ids[i % n_subscriptions]
+            disk = {
+                "id": f"/subscriptions/{subscription_id}/resourceGroups/rg-{i % 20}/providers/Microsoft.Compute/disks/disk-{i}",
+                "name": f"disk-{i}",
+                "type": "Microsoft.Compute/disks",
+                "location": REGIONS[i % len(REGIONS)],
+                "managedBy": f"/subscriptions/{subscription_id}/resourceGroups/rg-{i % 20}/providers/Microsoft.Compute/virtualMachines/vm-{i}",
+                "sku": {"name": SKU_NAMES[sku_index]},
+                "tags": {"fleet": "benchmark"},
+                "properties": {
+                    "diskSizeGB": DISK_SIZES[size_index],
+                    "diskIOPSReadWrite": 500,
+                    "diskMBpsReadWrite": 60,
+                    "diskState": "Attached",
+                    "provisioningState": "Succeeded"
+                }
+            }
+            self.disks.append(disk)
+            self.disks_by_subscription[subscription_id].append(disk)
+        disk_skus = json.load(
+            open(Path(__file__).parent.parent / "modules/disk_sku.json", "r"))
+        self.retail_prices = {region: get_retail_prices(
+            region, disk_skus) for region in REGIONS}
+
+
+def get_retail_prices(region: str, disk_skus: dict) -> list:
+    product_names = {"STANDARD_HDD": "Standard HDD Managed Disks",
+                     "STANDARD_SSD": "Standard SSD Managed Disks", "PREMIUM_SSD": "Premium SSD Managed Disks"}
+    unit_prices = {"STANDARD_HDD": 0.0005, "STANDARD_SSD": 0.001, "PREMIUM_SSD": 0.0015}
+    retail_prices = []
+    for family, tiers in disk_skus.items():
+        for tier, limits in tiers.items():
+            for redundancy in ["LRS", "ZRS"]:
+                item = {"armRegionName": region, "productName": product_names[family], "skuName": f"{tier} {redundancy}",
+                        "type": "Consumption", "unitOfMeasure": "1/Month", "currencyCode": "USD"}
+                factor = 1.5 if redundancy == "ZRS" else 1
+                if family == "PREMIUM_SSD":
+                    retail_prices.append({**item, "meterName": f"{tier} {redundancy} Disk",
+                                          "retailPrice": round(limits["size"] * unit_prices[family] * 100 * factor, 4)})
+                else:
+                    retail_prices.append({**item, "meterName": f"{tier} Disks",
+                                          "retailPrice": round(limits["size"] * unit_prices[family] * 100 * factor, 4)})
+                    retail_prices.append({**item, "meterName": "Disk Operations", "unitOfMeasure": "10K",
+                                          "retailPrice": 0.0005 * factor})
+    item = {"armRegionName": region, "productName": "Azure Premium SSD v2", "skuName": "Premium LRS",
+            "type": "Consumption", "unitOfMeasure": "1/Hour", "currencyCode": "USD"}
+    for meter, price in (("Provisioned Capacity", 0.000115), ("Provisioned IOPS", 0.0000068), ("Provisioned Throughput (MBps)", 0.000055)):
+        retail_prices.append(
+            {**item, "meterName": f"Premium LRS {meter}", "retailPrice": price})
+    return retail_prices
+
+
+def get_metrics_values(disk_index: int, start_date: str, end_date: str, interval_ISO: str) -> list:
+    start = np.datetime64(start_date.rstrip("Z")[:19], "s")
+    interval_seconds = int(np.timedelta64(
+        int(re.findall(r"\d+", interval_ISO)[0]), {"M": "m", "H": "h", "D": "D"}[interval_ISO[-1]]) / np.timedelta64(1, "s"))
+    n_points = max(1, int((np.datetime64(end_date.rstrip("Z")[:19], "s") - start) /
+                   np.timedelta64(interval_seconds, "s")))
+    timestamps = [f"{timestamp}Z" for timestamp in start +
+                  np.arange(n_points) * np.timedelta64(interval_seconds, "s")]
+    rng = np.random.default_rng(disk_index)
+    values = []
+    for name, scale in [("Composite Disk Read Bytes/sec", 4 * 1024 * 1024), ("Composite Disk Write Bytes/sec", 2 * 1024 * 1024),
+                        ("Composite Disk Read Operations/sec", 60), ("Composite Disk Write Operations/sec", 30)]:
+        maxima = rng.gamma(2, scale / 2, n_points)
+        values.append({"name": {"value": name, "localizedValue": name}, "unit": "CountPerSecond", "timeseries": [{"data": [
+            {"timeStamp": timestamp, "average": round(maximum / 2, 2), "maximum": round(maximum, 2)} for timestamp, maximum in zip(timestamps, maxima)]}]})
+    return values
+
+
+def get_handler(fleet: Fleet, latency_ms: float = 0, throttle_rate: float = 0, retry_after: int = 0):
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def send_json(self, status: int, body: dict, headers: dict = {}):
+            content = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(content)))
+            for key, value in headers.items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(content)
+
+        def read_json(self) -> dict:
+            length = int(self.headers.get("Content-Length", 0))
+            return json.loads(self.rfile.read(length)) if length else {}
+
+        def base_url(self) -> str:
+            return f"http://{self.headers['Host']}"
+
+        def simulate(self) -> bool:
+            # Returns False when the request was throttled
+            if latency_ms:
+                time.sleep(latency_ms / 1000)
+            if throttle_rate and random.random() < throttle_rate:
+                self.send_json(429, {"error": {"code": "TooManyRequests"}}, {
+                               "Retry-After": str(retry_after)})
+                return False
+            return True
+
+        def do_GET(self):
+            body = self.read_json()
+            if not self.simulate():
+                return
+            url = urlsplit(self.path)
+            query = {key: values[0] for key, values in parse_qs(url.query).items()}
+            path = url.path.rstrip("/")
+            if path == "/subscriptions":
+                return self.send_json(200, {"value": [{"id": f"/subscriptions/{subscription_id}", "subscriptionId": subscription_id, "displayName": subscription_id, "state": "Enabled"} for subscription_id in fleet.subscription_ids]})
+            match = re.fullmatch(
+                r"/subscriptions/([^/]+)/providers/Microsoft\.Compute/disks", path, re.IGNORECASE)
+            if match:
+                disks = fleet.disks_by_subscription.get(match.group(1), [])
+                skip = int(query.get("$skiptoken", 0))
+                page = {"value": disks[skip:skip + DISKS_PAGE_SIZE]}
+                if skip + DISKS_PAGE_SIZE < len(disks):
+                    page["nextLink"] = f"{self.base_url()}{path}?api-version={query.get('api-version')}&$skiptoken={skip + DISKS_PAGE_SIZE}"
+                return self.send_json(200, page)
+            match = re.fullmatch(
+                r"(/subscriptions/.+/disks/disk-(\d+))/providers/Microsoft\.Insights/metrics", path, re.IGNORECASE)
+            if match:
+                start_date, end_date = query["timespan"].split("/")
+                return self.send_json(200, {"timespan": query["timespan"], "interval": query.get("interval", "PT1M"), "value": get_metrics_values(int(match.group(2)), start_date, end_date, query.get("interval", "PT1M"))})
+            if path == "/api/retail/prices":
+                region = re.search(
+                    r"armRegionName eq '([^']+)'", query.get("$filter", ""))
+                sku_name = re.search(
+                    r"skuName eq '([^']+)'", query.get("$filter", ""))
+                retail_prices = [item for item in fleet.retail_prices.get(region.group(1) if region else "", [])
+                                 if sku_name is None or item["skuName"] == sku_name.group(1)]
+                skip = int(query.get("$skip", 0))
+                page = {"Items": retail_prices[skip:skip + PRICES_PAGE_SIZE], "NextPageLink": None}
+                if skip + PRICES_PAGE_SIZE < len(retail_prices):
+                    page["NextPageLink"] = f"{self.base_url()}/api/retail/prices?$filter={query.get('$filter', '')}&$skip={skip + PRICES_PAGE_SIZE}"
+                return self.send_json(200, page)
+            self.send_json(404, {"error": {"code": "NotFound", "message": path}})
+
+        def do_POST(self):
+            body = self.read_json()
+            if not self.simulate():
+                return
+            url = urlsplit(self.path)
+            query = {key: values[0] for key, values in parse_qs(url.query).items()}
+            path = url.path.rstrip("/")
+            if re.fullmatch(r"/subscriptions/[^/]+/metrics:getBatch", path, re.IGNORECASE):
+                values = []
+                for resource_id in body.get("resourceids", []):
+                    values.append({"resourceid": resource_id, "starttime": query["starttime"], "endtime": query["endtime"], "interval": query.get("interval", "PT1M"),
+                                   "value": get_metrics_values(int(resource_id.rsplit("-", 1)[1]), query["starttime"], query["endtime"], query.get("interval", "PT1M"))})
+                return self.send_json(200, {"values": values})
+            if path == "/providers/Microsoft.ResourceGraph/resources":
+                options = body.get("options", {})
+                top = options.get("$top", DISKS_PAGE_SIZE)
+                skip = int(options.get("$skipToken", 0))
+                subscription_ids = set(body.get("subscriptions", []))
+                disks = [disk for subscription_id in fleet.subscription_ids if subscription_id in subscription_ids
+                         for disk in fleet.disks_by_subscription[subscription_id]]
+                rows = [{"id": disk["id"], "name": disk["name"], "location": disk["location"], "managed_by": disk["managedBy"], "managed_by_extended": None,
+                         "disk_state": disk["properties"]["diskState"], "sku_name": disk["sku"]["name"], "tier": None, "disk_size_gb": disk["properties"]["diskSizeGB"],
+                         "disk_iops_read_write": disk["properties"]["diskIOPSReadWrite"], "disk_m_bps_read_write": disk["properties"]["diskMBpsReadWrite"], "tags": disk["tags"]} for disk in disks[skip:skip + top]]
+                result = {"totalRecords": len(disks), "count": len(rows), "data": rows}
+                if skip + top < len(disks):
+                    result["$skipToken"] = str(skip + top)
+                return self.send_json(200, result)
+            self.send_json(404, {"error": {"code": "NotFound", "message": path}})
+
+    return StubHandler
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 256
+
+
+def serve(port: int = 8765, n_disks: int = 1000, disks_per_subscription: int = 500, latency_ms: float = 0, throttle_rate: float = 0, retry_after: int = 0) -> None:
+    fleet = Fleet(n_disks, disks_per_subscription)
+    server = StubServer(("127.0.0.1", port), get_handler(
+        fleet, latency_ms=latency_ms, throttle_rate=throttle_rate, retry_after=retry_after))
+    print(f"Serving {n_disks} disks on http://127.0.0.1:{port}", flush=True)
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    serve(args.port, args.n_disks, args.disks_per_subscription,
+          args.latency_ms, args.throttle_rate, args.retry_after)
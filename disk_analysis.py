@@ -5,135 +5,311 @@
 import json
 import argparse
 import pandas as pd
-# import multiprocessing
-from tqdm import tqdm
 from pathlib import Path
-from azure.identity import DefaultAzureCredential
-from azure.mgmt.subscription import SubscriptionClient
-from modules.compute import get_list_disks_df, get_tier, get_lower_recommended_tier
-from modules.metrics import get_disk_throughput_IOPS
-from modules.helpers import power_of_two
-from modules.pricing import get_tier_pricing, summarize
+from modules.compute import DISKS_SCHEMA, SIZING_POLICIES, iter_list_disks_chunks, get_tier_table, get_tiers, get_lower_recommended_tiers, get_policy_columns
+from modules.metrics import get_disks_throughput_IOPS, get_disks_throughput_IOPS_batch, get_disks_throughput_IOPS_incremental, get_disks_timeseries
+from modules.metrics_cache import MetricsCache
+from modules.timeseries import TimeseriesStore, get_interval_seconds, get_timeseries_stats, get_sustained_minutes_over_limits
+from modules.instrumentation import run_report
+from modules.helpers import MANAGEMENT_ENDPOINT, LazyCredential, get_sdk_client_kwargs
+from modules.pricing import load_price_index, get_indexed_tier_pricing, estimate_costs, summarize
+from modules.optimizer import get_cheapest_recommendations
+from modules.storage import table_exists, read_table, write_table, write_table_chunks
 
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--use_disks_df", action="store_true",
-                    help="Use saved disk_df.csv file if exists or pull and create it if not.")
+                    help="Use saved tables (data/*.parquet) if they exist or pull and create them if not.")
+parser.add_argument("--filter_subscription_id", type=str, default=None,
+                    help="Only analyse the disks of this subscription, read from saved tables without loading the other disks.")
+parser.add_argument("--filter_location", type=str, default=None,
+                    help="Only analyse the disks of this region (e.g. westeurope), read from saved tables without loading the other disks.")
 parser.add_argument("--PAYG_discount", type=float, default=0,
                     help="Enteprise discount on PAYG between 0 and 1. Default is 0.")
-parser.add_argument("--timerange_days_metrics", type=str, default=3,
+parser.add_argument("--timerange_days_metrics", type=int, default=3,
                     help="Number of days to use for metrics. Default is 3.")
 parser.add_argument("--interval_ISO_metrics", type=str, default="PT1M",
                     help="Interval ISO to use for metrics (granularity). Default is PT1M.")
+parser.add_argument("--max_workers_inventory", type=int, default=8,
+                    help="Number of subscriptions listed concurrently to get disks. Default is 8.")
+parser.add_argument("--use_resource_graph", action="store_true",
+                    help="Use Azure Resource Graph to get the disk inventory in a few paged queries.")
+parser.add_argument("--max_workers_metrics", type=int, default=16,
+                    help="Number of concurrent requests used to get disk metrics. Default is 16.")
+parser.add_argument("--batch_metrics", action="store_true",
+                    help="Use the Azure Monitor batch metrics API to get metrics of many disks per request.")
+parser.add_argument("--timeseries_store", type=str, default=None,
+                    help="Directory keeping the full throughput and IOPS series of every disk (e.g. data/timeseries), reused with --use_disks_df.")
+parser.add_argument("--sizing_policy", type=str, default="max", choices=SIZING_POLICIES,
+                    help="Statistic of throughput and IOPS used to recommend tiers, percentiles require --timeseries_store. Default is max.")
+parser.add_argument("--recommendation_engine", type=str, default="lower_tier", choices=["lower_tier", "cheapest"],
+                    help="lower_tier only moves disks to the same size Standard SSD/HDD tier, cheapest picks the cheapest SKU, size and redundancy-preserving option (Premium SSD v2 included) meeting the sizing policy. Default is lower_tier.")
+parser.add_argument("--exclude_premium_v2", action="store_true",
+                    help="Do not recommend Premium SSD v2 with --recommendation_engine cheapest (e.g. for OS disks, which cannot use it).")
+parser.add_argument("--price_cache_ttl_hours", type=float, default=24,
+                    help="Hours before cached regional price sheets (data/prices) are downloaded again. Default is 24.")
+parser.add_argument("--metrics_cache", type=str, default=None,
+                    help="Path of a SQLite metrics cache (e.g. data/metrics_cache.sqlite). Only metrics missing from it are fetched.")
+parser.add_argument("--serve", action="store_true",
+                    help="Run as a service keeping recommendations up to date and serving them on a local HTTP/JSON endpoint.")
+parser.add_argument("--port", type=int, default=8080,
+                    help="Port of the local HTTP/JSON endpoint of --serve. Default is 8080.")
+parser.add_argument("--poll_interval_minutes", type=float, default=60,
+                    help="Minutes between two refreshes of inventory and metrics with --serve. Default is 60.")
+parser.add_argument("--report_path", type=str, default=None,
+                    help="Path of a JSON report with per stage wall time, request statistics and peak memory of the run.")
 
 
-def main(args):
-    # Get token from Azure AD powershell - for example, use "Connect-AzAccount" to get token
-    credential = DefaultAzureCredential()
+# Columns of the disks table used by the analysis, the others are kept in the table but not read
+ANALYSIS_DISK_COLUMNS = ["id", "subscription_id", "location", "sku_name",
+                         "disk_size_gb", "disk_iops_read_write", "disk_m_bps_read_write"]
+
+
+def get_disks_filters(args) -> list:
+    filters = []
+    if args.filter_subscription_id:
+        filters.append(("subscription_id", "==", args.filter_subscription_id))
+    if args.filter_location:
+        # Azure region names are lowercase and the filter is an exact comparison
+        filters.append(("location", "==", args.filter_location.lower()))
+    return filters
+
+
+def load_disks_df(args, credential) -> pd.DataFrame:
     # Get list of disks
-    path = Path("data/disks_df.pkl")
-    if path.is_file() and args.use_disks_df:
-        print("Using saved disk_df.pkl file.")
-        disks_df = pd.read_pickle(path)
-    else:
-        subscription_client = SubscriptionClient(credential)
-        disks_df = get_list_disks_df(credential, subscription_client)
-        path.parent.mkdir(parents=True, exist_ok=True)
-        disks_df.to_pickle(path)
-    # print(disks_df.columns)
+    filters = get_disks_filters(args)
+    if args.use_disks_df and table_exists("disks"):
+        print("Using saved disks table.")
+        return read_table("disks", columns=ANALYSIS_DISK_COLUMNS, filters=filters)
+    from azure.mgmt.subscription import SubscriptionClient
+    subscription_client = SubscriptionClient(
+        credential, base_url=MANAGEMENT_ENDPOINT, **get_sdk_client_kwargs("subscriptions"))
+    # Chunks are written as they are received so that the whole inventory is never held in memory, the filters only apply to this run
+    write_table_chunks(iter_list_disks_chunks(credential, subscription_client, max_workers=args.max_workers_inventory,
+                                              use_resource_graph=args.use_resource_graph), "disks", DISKS_SCHEMA)
+    return read_table("disks", columns=ANALYSIS_DISK_COLUMNS, filters=filters)
+
+
+def load_disks_throughput_IOPS_df(args, credential, disks_df: pd.DataFrame) -> pd.DataFrame:
     # Get throughput and IOPS for each disk
-    path_throughout_IOPS = Path("data/disks_throughput_IOPS_df.pkl")
-    if path_throughout_IOPS.is_file() and args.use_disks_df:
-        print("Using saved disks_throughput_IOPS_df.pkl file.")
-        disks_throughput_IOPS_df = pd.read_pickle(path_throughout_IOPS)
+    if args.timeseries_store:
+        timeseries_store = TimeseriesStore(args.timeseries_store)
+        saved = args.use_disks_df and timeseries_store.exists()
+        # Series saved by a run filtered on other disks, at another interval or over a shorter time range are collected again
+        # rather than silently leaving disks out or sizing them on other data
+        covers_window = saved and timeseries_store.covers(
+            args.timerange_days_metrics, get_interval_seconds(args.interval_ISO_metrics))
+        if covers_window and set(disks_df.id) <= set(timeseries_store.load()[0]["disk_ids"]):
+            print(f"Using saved time series from {args.timeseries_store}.")
+        else:
+            if saved and not covers_window:
+                print(
+                    f"Saved time series in {args.timeseries_store} do not cover {args.timerange_days_metrics} days at {args.interval_ISO_metrics}, collecting them again.")
+            elif saved:
+                print(
+                    f"Saved time series in {args.timeseries_store} do not cover every disk, collecting them again.")
+            get_disks_timeseries(disks_df.id.tolist(), disks_df.location.tolist(), credential, timeseries_store, interval_ISO=args.interval_ISO_metrics,
+                                 timerange_days=args.timerange_days_metrics, max_workers=args.max_workers_metrics, batch=args.batch_metrics)
+        # Statistics are computed from the stored series, so changing the sizing policy does not fetch anything
+        timeseries_metadata, throughput_timeseries, IOPS_timeseries = timeseries_store.load_window(
+            args.timerange_days_metrics)
+        return pd.DataFrame({"id": timeseries_metadata["disk_ids"], **get_timeseries_stats(
+            throughput_timeseries, IOPS_timeseries)})
+    if args.metrics_cache:
+        metrics_cache = MetricsCache(args.metrics_cache)
+        disks_throughput_IOPS_df = pd.DataFrame(get_disks_throughput_IOPS_incremental(
+            disks_df.id.tolist(), disks_df.location.tolist(), credential, metrics_cache, interval_ISO=args.interval_ISO_metrics, timerange_days=args.timerange_days_metrics, max_workers=args.max_workers_metrics, batch=args.batch_metrics))
+        metrics_cache.close()
+        return disks_throughput_IOPS_df
+    if args.use_disks_df and table_exists("disks_throughput_IOPS"):
+        saved_df = read_table("disks_throughput_IOPS", filters=[
+                              ("id", "in", disks_df.id.tolist())] if get_disks_filters(args) and len(disks_df) else None)
+        # The table only covers the disks of the runs that wrote it (e.g. filtered runs), the missing ones are fetched and added
+        missing_disks_df = disks_df[~disks_df.id.isin(saved_df.id)]
+        if not len(missing_disks_df):
+            print("Using saved disks_throughput_IOPS table.")
+            return saved_df
+        print(
+            f"Using saved disks_throughput_IOPS table, fetching the metrics of {len(missing_disks_df)} disks missing from it.")
+        missing_df = fetch_disks_throughput_IOPS_df(
+            args, credential, missing_disks_df)
+        write_table(pd.concat([read_table("disks_throughput_IOPS"), missing_df],
+                    ignore_index=True), "disks_throughput_IOPS")
+        return pd.concat([saved_df, missing_df], ignore_index=True)
+    disks_throughput_IOPS_df = fetch_disks_throughput_IOPS_df(
+        args, credential, disks_df)
+    write_table(disks_throughput_IOPS_df, "disks_throughput_IOPS")
+    return disks_throughput_IOPS_df
+
+
+def fetch_disks_throughput_IOPS_df(args, credential, disks_df: pd.DataFrame) -> pd.DataFrame:
+    if args.batch_metrics:
+        list_disks_throughput_IOPS = get_disks_throughput_IOPS_batch(
+            disks_df.id.tolist(), disks_df.location.tolist(), credential, interval_ISO=args.interval_ISO_metrics, timerange_days=args.timerange_days_metrics, max_workers=args.max_workers_metrics)
     else:
-        token = credential.get_token(
-                "https://management.azure.com/.default").token
-        list_disks_throughput_IOPS = []
-        for _, disk in tqdm(disks_df.iterrows(), total=disks_df.shape[0], desc="Getting disk throughput and IOPS..."):
-            throughput, IOPS = get_disk_throughput_IOPS(
-                disk.id, token, interval_ISO=args.interval_ISO_metrics, timerange_days=args.timerange_days_metrics)
-            list_disks_throughput_IOPS.append({
-                "id": disk.id,
-                "throughput": throughput,
-                "IOPS": IOPS
-            })
-
-        disks_throughput_IOPS_df = pd.DataFrame(list_disks_throughput_IOPS)
-        path_throughout_IOPS.parent.mkdir(parents=True, exist_ok=True)
-        disks_throughput_IOPS_df.to_pickle(path_throughout_IOPS)
-    # print(disks_throughput_IOPS_df.head())
+        list_disks_throughput_IOPS = get_disks_throughput_IOPS(
+            disks_df.id.tolist(), credential, interval_ISO=args.interval_ISO_metrics, timerange_days=args.timerange_days_metrics, max_workers=args.max_workers_metrics)
+    return pd.DataFrame(list_disks_throughput_IOPS, columns=["id", "throughput", "IOPS"])
+
 
-    disk_skus = json.load(open("modules/disk_sku.json", "r"))
-    STANDARD_HDD = disk_skus["STANDARD_HDD"]
-    STANDARD_SSD = disk_skus["STANDARD_SSD"]
-    PREMIUM_SSD = disk_skus["PREMIUM_SSD"]
+def get_recommendations_df(args, disks_df: pd.DataFrame, disks_throughput_IOPS_df: pd.DataFrame, tier_table: pd.DataFrame) -> pd.DataFrame:
     # Get current tier and size for each disk
-    list_disks_tier_size = []
-    for _, disk in disks_df.iterrows():
-        list_disks_tier_size.append({
-            "id": disk.id,
-            "tier": get_tier(power_of_two(disk.disk_size_gb), disk.sku_name, STANDARD_HDD, STANDARD_SSD, PREMIUM_SSD),
-            "size": disk.disk_size_gb
-        })
-    disks_tier_size_df = pd.DataFrame(list_disks_tier_size)
+    disks_tier_size_df = pd.DataFrame({
+        "id": disks_df.id,
+        "tier": get_tiers(disks_df.disk_size_gb, disks_df.sku_name, tier_table),
+        "size": disks_df.disk_size_gb
+    })
     # print(disks_tier_size_df.head())
     # Merge throughput and IOPS with tier and size
     disks_metrics_tier = disks_tier_size_df.merge(
         disks_throughput_IOPS_df, on="id")
     # print(disks_metrics_tier.head())
     # Get recommended tier and size for each disk
-    list_disks_recommendation = []
-    for _, disk in disks_metrics_tier.iterrows():
-        list_disks_recommendation.append({
-            "id": disk.id,
-            "current_tier": disk.tier,
-            "recommended_tier": get_lower_recommended_tier(disk.tier, disk.throughput, disk.IOPS, STANDARD_HDD, STANDARD_SSD),
-            "iops": disk.IOPS,
-        })
-    disks_recommendation_df = pd.DataFrame(list_disks_recommendation)
+    throughput_column, IOPS_column = get_policy_columns(args.sizing_policy)
+    if throughput_column not in disks_metrics_tier.columns:
+        raise ValueError(
+            f"Sizing policy {args.sizing_policy} requires the time series of the disks, use --timeseries_store.")
+    disks_recommendation_df = pd.DataFrame({
+        "id": disks_metrics_tier.id,
+        "current_tier": disks_metrics_tier.tier,
+        "recommended_tier": get_lower_recommended_tiers(disks_metrics_tier.tier, disks_metrics_tier[throughput_column], disks_metrics_tier[IOPS_column], tier_table),
+        "iops": disks_metrics_tier.IOPS
+    })
     # disks_recommendation_df.to_csv("data/disks_recommendation.csv", index=False)
-    disks_redundancy_recommendation_df = disks_recommendation_df.merge(
+    return disks_recommendation_df.merge(
         disks_df[["id", "sku_name", "location"]], on="id")
-    # print(disks_redundancy_recommendation_df.head())
+
+
+def get_cheapest_recommendations_df(args, disks_df: pd.DataFrame, disks_throughput_IOPS_df: pd.DataFrame, tier_table: pd.DataFrame, price_index: dict) -> pd.DataFrame:
+    # Cheapest SKU and size of every disk among all SKUs, priced with their costs directly from the regional price sheets
+    disks_metrics = disks_df.merge(disks_throughput_IOPS_df, on="id")
+    throughput_column, IOPS_column = get_policy_columns(args.sizing_policy)
+    if throughput_column not in disks_metrics.columns:
+        raise ValueError(
+            f"Sizing policy {args.sizing_policy} requires the time series of the disks, use --timeseries_store.")
+    return get_cheapest_recommendations(disks_metrics, disks_metrics[throughput_column], disks_metrics[IOPS_column], disks_metrics.IOPS, tier_table, price_index,
+                                        allow_premium_v2=not args.exclude_premium_v2)
+
+
+def add_sustained_minutes(args, disks_recommendation_pricing_df: pd.DataFrame, tier_table: pd.DataFrame) -> pd.DataFrame:
+    # Longest run and total minutes of the stored time series during which the load is above the throughput or IOPS limits of the
+    # recommended tier, i.e. how long the disk would have been throttled after the change (0 with the max sizing policy)
+    timeseries_metadata, throughput_timeseries, IOPS_timeseries = TimeseriesStore(
+        args.timeseries_store).load_window(args.timerange_days_metrics)
+    df = disks_recommendation_pricing_df
+    if "recommended_throughput" in df.columns:
+        throughput_limits, IOPS_limits = df.recommended_throughput, df.recommended_IOPS
+    else:
+        limits = tier_table.reindex(df.recommended_tier)
+        throughput_limits, IOPS_limits = limits.throughput, limits.IOPS
+    longest_runs, totals = get_sustained_minutes_over_limits(throughput_timeseries, IOPS_timeseries, pd.Index(timeseries_metadata["disk_ids"]).get_indexer(df.id),
+                                                             throughput_limits, IOPS_limits, timeseries_metadata["interval_seconds"])
+    return df.assign(over_recommended_limits_longest_minutes=longest_runs, over_recommended_limits_total_minutes=totals)
+
+
+def load_tier_table() -> pd.DataFrame:
+    disk_skus = json.load(
+        open(Path(__file__).parent / "modules/disk_sku.json", "r"))
+    # Tier lookup table built once and used for the vectorized tier and recommendation computations
+    return get_tier_table(disk_skus)
+
+
+def load_tier_pricing_df(args, disks_redundancy_recommendation_df: pd.DataFrame) -> pd.DataFrame:
     tier_location_pricing_df = pd.concat([disks_redundancy_recommendation_df[["current_tier", "location"]].rename(columns={"current_tier": "tier"}, inplace=False), disks_redundancy_recommendation_df[[
                                          "recommended_tier", "location"]].rename(columns={"recommended_tier": "tier"}, inplace=False)]).drop_duplicates()
 
-    path_tier_pricing = Path("data/tier_pricing_df.pkl")
-    if path_tier_pricing.is_file() and args.use_disks_df:
-        print("Using saved tier_pricing_df.pkl file.")
-        tier_pricing_df = pd.read_pickle(path_tier_pricing)
+    # Priced from the regional price sheets cached in data/prices (see --price_cache_ttl_hours), one download per region missing from it,
+    # so that the tiers and regions of every run are covered
+    price_index = load_price_index(
+        tier_location_pricing_df.location.tolist(), ttl_hours=args.price_cache_ttl_hours)
+    list_tier_pricing = []
+    for tier, location in zip(tier_location_pricing_df.tier, tier_location_pricing_df.location):
+        fixed_pricing, variable_pricing = get_indexed_tier_pricing(
+            tier, location, price_index, redundancy="LRS")
+        list_tier_pricing.append({
+            "tier": tier,
+            "location": location,
+            "fixed_pricing": fixed_pricing,
+            "variable_pricing": variable_pricing
+        })
+    return pd.DataFrame(list_tier_pricing)
+
+
+def main(args, credential=None):
+    run_report.reset(metadata={"args": vars(args)})
+    # Get token from Azure AD powershell - for example, use "Connect-AzAccount" to get token
+    # The credential (and the Azure SDK) is only loaded by the first stage that is not served from saved tables
+    credential = credential or LazyCredential()
+    with run_report.stage("inventory"):
+        disks_df = load_disks_df(args, credential)
+    if not len(disks_df):
+        # Nothing to analyse, e.g. a filter on a subscription or region without disks
+        filters = get_disks_filters(args)
+        raise ValueError(f"No disks found for {', '.join(f'{column} {value}' for column, _, value in filters)}." if filters else "No disks found.")
+    run_report.increment("disks", len(disks_df))
+    # print(disks_df.columns)
+    with run_report.stage("metrics"):
+        disks_throughput_IOPS_df = load_disks_throughput_IOPS_df(
+            args, credential, disks_df)
+    run_report.increment("disks_without_metrics", int(
+        (disks_throughput_IOPS_df.throughput == 0).sum()))
+    # print(disks_throughput_IOPS_df.head())
+
+    if args.recommendation_engine == "cheapest":
+        with run_report.stage("pricing"):
+            price_index = load_price_index(
+                disks_df.location.astype(str).tolist(), ttl_hours=args.price_cache_ttl_hours)
+        with run_report.stage("recommendations"):
+            disks_recommendation_pricing_df = get_cheapest_recommendations_df(
+                args, disks_df, disks_throughput_IOPS_df, load_tier_table(), price_index)
     else:
-        token = credential.get_token(
-            "https://management.azure.com/.default").token
-        list_tier_pricing = []
-        for _, item in tqdm(tier_location_pricing_df.iterrows(), total=tier_location_pricing_df.shape[0], desc="Getting pricing for current and recommended tier..."):
-            fixed_pricing, variable_pricing = get_tier_pricing(
-                item.tier, item.location, redundancy="LRS")
-            list_tier_pricing.append({
-                "tier": item.tier,
-                "location": item.location,
-                "fixed_pricing": fixed_pricing,
-                "variable_pricing": variable_pricing
-            })
-        tier_pricing_df = pd.DataFrame(list_tier_pricing)
-        path_tier_pricing.parent.mkdir(parents=True, exist_ok=True)
-        tier_pricing_df.to_pickle(path_tier_pricing)
-    # Merge pricing with recommendation
-    disks_recommendation_pricing_df = disks_redundancy_recommendation_df[["id", "current_tier", "recommended_tier", "location", "iops"]].merge(tier_pricing_df, left_on=["current_tier", "location"], right_on=[
-                                                                                                                                               "tier", "location"], how="left").drop(columns=["tier"]).rename(columns={"fixed_pricing": "current_fixed_pricing", "variable_pricing": "current_variable_pricing"})
-    disks_recommendation_pricing_df = disks_recommendation_pricing_df.merge(tier_pricing_df, left_on=["recommended_tier", "location"], right_on=["tier", "location"], how="left").drop(
-        columns=["tier"]).rename(columns={"fixed_pricing": "recommended_fixed_pricing", "variable_pricing": "recommended_variable_pricing"})
-    disks_recommendation_pricing_df["estimated_current_variable_pricing"] = disks_recommendation_pricing_df[[
-        "iops", "current_variable_pricing"]].apply(lambda x: x.iops / 10000 * 720 * 3600 * x.current_variable_pricing, axis=1)
-    disks_recommendation_pricing_df["estimated_recommended_variable_pricing"] = disks_recommendation_pricing_df[[
-        "iops", "recommended_variable_pricing"]].apply(lambda x: x.iops / 10000 * 720 * 3600 * x.recommended_variable_pricing, axis=1)
+        with run_report.stage("recommendations"):
+            disks_redundancy_recommendation_df = get_recommendations_df(
+                args, disks_df, disks_throughput_IOPS_df, load_tier_table())
+        # print(disks_redundancy_recommendation_df.head())
+        with run_report.stage("pricing"):
+            tier_pricing_df = load_tier_pricing_df(
+                args, disks_redundancy_recommendation_df)
+        with run_report.stage("cost_estimation"):
+            # Price current and recommended tiers
+            disks_recommendation_pricing_df = estimate_costs(
+                disks_redundancy_recommendation_df, tier_pricing_df)
+    if args.timeseries_store:
+        with run_report.stage("sustained_minutes"):
+            disks_recommendation_pricing_df = add_sustained_minutes(
+                args, disks_recommendation_pricing_df, load_tier_table())
     # print(disks_recommendation_pricing_df.head())
     # Display recommendations
-    summarize(disks_recommendation_pricing_df,
-              PAYG_discount=args.PAYG_discount)
+    with run_report.stage("summary"):
+        summarize(disks_recommendation_pricing_df,
+                  PAYG_discount=args.PAYG_discount)
+    if args.report_path:
+        print(f"Saving run performance report to {args.report_path}.")
+        run_report.save(args.report_path)
+
+
+def run_service(args, credential=None):
+    if args.sizing_policy != "max":
+        raise ValueError(
+            "Only the max sizing policy is supported with --serve.")
+    if args.recommendation_engine != "lower_tier":
+        raise ValueError(
+            "Only the lower_tier recommendation engine is supported with --serve.")
+    from azure.mgmt.subscription import SubscriptionClient
+    from modules.service import DiskAnalysisService, serve
+    credential = credential or LazyCredential()
+    service = DiskAnalysisService(credential, SubscriptionClient(credential, base_url=MANAGEMENT_ENDPOINT, **get_sdk_client_kwargs("subscriptions")), load_tier_table(),
+                                  MetricsCache(args.metrics_cache or "data/metrics_cache.sqlite"), interval_ISO=args.interval_ISO_metrics,
+                                  timerange_days=args.timerange_days_metrics, max_workers_inventory=args.max_workers_inventory,
+                                  max_workers_metrics=args.max_workers_metrics, batch_metrics=args.batch_metrics,
+                                  use_resource_graph=args.use_resource_graph, price_cache_ttl_hours=args.price_cache_ttl_hours)
+    serve(service, port=args.port,
+          poll_interval_minutes=args.poll_interval_minutes)
 
 
 if __name__ == "__main__":
     args = parser.parse_args()
-    main(args)
+    if args.serve:
+        run_service(args)
+    else:
+        main(args)
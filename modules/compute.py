@@ -1,39 +1,175 @@
-from tqdm import tqdm
+from __future__ import annotations
+import json
+import queue
+import threading
+import numpy as np
 import pandas as pd
-from azure.identity import DefaultAzureCredential
-from azure.mgmt.subscription import SubscriptionClient
-from azure.mgmt.compute import ComputeManagementClient
-
-
-def get_list_disks_df(credential: DefaultAzureCredential, subscription_client: SubscriptionClient) -> pd.DataFrame:
-    disk_list = []
-
-    def schema_lambda(x): return {
-        "id": x.id,
-        "name": x.name,
-        "subscription_id": x.id.split('/')[2],
-        "rg_id": x.id.split('/')[4],
-        "location": x.location,
-        "managed_by": x.managed_by,
-        "managed_by_extended": x.managed_by_extended,
-        "disk_state": x.disk_state,
-        "sku_name": x.sku.name,
-        "tier": x.tier,
-        "disk_size_gb": x.disk_size_gb,
-        "disk_iops_read_write": x.disk_iops_read_write,
-        "disk_m_bps_read_write": x.disk_m_bps_read_write,
-        "tags": x.tags
-    }
-    sub_list = list(subscription_client.subscriptions.list())
-    for subscription in tqdm(sub_list, desc="Searching disks in subscriptions...", ncols=len(sub_list)):
-        # print(subscription.display_name, subscription.id)
-        compute_client = ComputeManagementClient(
-            credential, subscription.subscription_id)
-        disk_list.extend(
-            map(schema_lambda, compute_client.disks.list())
-        )
-    disk_df = pd.DataFrame.from_dict(disk_list)
-    return disk_df
+import pyarrow as pa
+from typing import TYPE_CHECKING, Iterator, List, Mapping, Union
+from concurrent.futures import ThreadPoolExecutor
+from modules.helpers import MANAGEMENT_ENDPOINT, TokenProvider, get_sdk_client_kwargs, get_sdk_operation_kwargs, get_session, request_with_token
+from modules.instrumentation import run_report
+# Azure SDK, requests and tqdm are imported where used, so that runs served from saved tables start quickly
+if TYPE_CHECKING:
+    import requests
+    from azure.identity import DefaultAzureCredential
+    from azure.mgmt.subscription import SubscriptionClient
+
+
+SKU_NAME_FAMILIES = {
+    "Standard_LRS": "STANDARD_HDD",
+    "StandardSSD_LRS": "STANDARD_SSD",
+    "Premium_LRS": "PREMIUM_SSD"
+}
+DISK_COLUMNS = ["id", "name", "subscription_id", "rg_id", "location", "managed_by", "managed_by_extended", "disk_state",
+                "sku_name", "tier", "disk_size_gb", "disk_iops_read_write", "disk_m_bps_read_write", "tags"]
+# Statistic of the throughput and IOPS series used to size disks, "max" being a single burst minute
+SIZING_POLICIES = ["max", "p99", "p95", "p50"]
+CATEGORICAL_DISK_COLUMNS = ["location", "sku_name", "disk_state"]
+NUMERIC_DISK_COLUMNS = ["disk_size_gb",
+                        "disk_iops_read_write", "disk_m_bps_read_write"]
+# Arrow types of the disks table, fixed so that chunks written one by one agree even when a chunk has no value in a column
+DISKS_SCHEMA = pa.schema([(column, pa.dictionary(pa.int32(), pa.string()) if column in CATEGORICAL_DISK_COLUMNS else pa.int64()
+                           if column in NUMERIC_DISK_COLUMNS else pa.string()) for column in DISK_COLUMNS])
+RESOURCE_GRAPH_DISKS_QUERY = """resources
+| where type =~ 'microsoft.compute/disks'
+| project id, name, location, managed_by = managedBy, managed_by_extended = properties.managedByExtended,
+    disk_state = tostring(properties.diskState), sku_name = tostring(sku.name), tier = tostring(properties.tier),
+    disk_size_gb = tolong(properties.diskSizeGB), disk_iops_read_write = tolong(properties.diskIOPSReadWrite),
+    disk_m_bps_read_write = tolong(properties.diskMBpsReadWrite), tags
+| order by id asc"""
+# Maximum number of subscriptions and of rows per Azure Resource Graph request
+RESOURCE_GRAPH_MAX_SUBSCRIPTIONS = 1000
+RESOURCE_GRAPH_PAGE_SIZE = 1000
+
+
+def get_disks_chunk(columns: dict) -> pd.DataFrame:
+    # Typed columnar chunk of disks, ids are split once per column instead of building a dict per disk
+    ids_parts = [disk_id.split('/') for disk_id in columns["id"]]
+    columns["subscription_id"] = [parts[2] for parts in ids_parts]
+    columns["rg_id"] = [parts[4] for parts in ids_parts]
+    disks_chunk = pd.DataFrame({column: columns[column] for column in DISK_COLUMNS})
+    for column in NUMERIC_DISK_COLUMNS:
+        disks_chunk[column] = pd.to_numeric(disks_chunk[column])
+    return disks_chunk.astype({column: "category" for column in CATEGORICAL_DISK_COLUMNS})
+
+
+def get_sdk_disks_chunk(disks: list) -> pd.DataFrame:
+    return get_disks_chunk({
+        "id": [x.id for x in disks],
+        "name": [x.name for x in disks],
+        "location": [x.location for x in disks],
+        "managed_by": [x.managed_by for x in disks],
+        "managed_by_extended": [x.managed_by_extended for x in disks],
+        "disk_state": [x.disk_state for x in disks],
+        "sku_name": [x.sku.name for x in disks],
+        "tier": [x.tier for x in disks],
+        "disk_size_gb": [x.disk_size_gb for x in disks],
+        "disk_iops_read_write": [x.disk_iops_read_write for x in disks],
+        "disk_m_bps_read_write": [x.disk_m_bps_read_write for x in disks],
+        "tags": [x.tags for x in disks]
+    })
+
+
+def iter_disks_chunks(credential: DefaultAzureCredential, subscription_ids: List[str], max_workers: int = 8) -> Iterator[pd.DataFrame]:
+    # Subscriptions are listed concurrently and every page of disks is yielded as soon as it is received
+    from tqdm import tqdm
+    from azure.mgmt.compute import ComputeManagementClient
+    chunks = queue.Queue(maxsize=2 * max_workers)
+    stop = threading.Event()
+
+    def put(item):
+        # Bounded queue so that workers wait for a slow consumer, stop lets them exit if the consumer gives up
+        while not stop.is_set():
+            try:
+                chunks.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def list_subscription_disks(subscription_id: str):
+        try:
+            if stop.is_set():
+                return
+            compute_client = ComputeManagementClient(
+                credential, subscription_id, base_url=MANAGEMENT_ENDPOINT, **get_sdk_client_kwargs("inventory"))
+            for page in compute_client.disks.list(**get_sdk_operation_kwargs()).by_page():
+                if stop.is_set():
+                    return
+                disks_chunk = get_sdk_disks_chunk(list(page))
+                run_report.increment("inventory_pages")
+                run_report.increment("inventory_disks", len(disks_chunk))
+                put(disks_chunk)
+        except Exception:
+            run_report.record_failure("inventory")
+            raise
+        finally:
+            put(None)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(list_subscription_disks, subscription_id)
+                   for subscription_id in subscription_ids]
+        try:
+            with tqdm(total=len(futures), desc="Searching disks in subscriptions...") as progress_bar:
+                remaining = len(futures)
+                while remaining:
+                    chunk = chunks.get()
+                    if chunk is None:
+                        remaining -= 1
+                        progress_bar.update(1)
+                    elif len(chunk):
+                        yield chunk
+        finally:
+            stop.set()
+    for future in futures:
+        # Raise the first error of a subscription listing, if any
+        future.result()
+
+
+def iter_disks_chunks_resource_graph(credential: DefaultAzureCredential, subscription_ids: List[str], session: requests.Session = None) -> Iterator[pd.DataFrame]:
+    # Whole inventory in a few paged Azure Resource Graph queries instead of one listing per subscription
+    token = TokenProvider(credential)
+    session = session or get_session()
+    url = f"{MANAGEMENT_ENDPOINT}/providers/Microsoft.ResourceGraph/resources?api-version=2022-10-01"
+    for i in range(0, len(subscription_ids), RESOURCE_GRAPH_MAX_SUBSCRIPTIONS):
+        options = {"$top": RESOURCE_GRAPH_PAGE_SIZE,
+                   "resultFormat": "objectArray"}
+        while True:
+            response = request_with_token(session, "POST", url, token, kind="resource_graph", json={
+                "subscriptions": subscription_ids[i:i + RESOURCE_GRAPH_MAX_SUBSCRIPTIONS],
+                "query": RESOURCE_GRAPH_DISKS_QUERY,
+                "options": options
+            })
+            response.raise_for_status()
+            result = json.loads(response.content)
+            run_report.increment("inventory_pages")
+            run_report.increment("inventory_disks", len(result["data"]))
+            if result["data"]:
+                yield get_disks_chunk({column: [row.get(column) for row in result["data"]] for column in DISK_COLUMNS})
+            if not result.get("$skipToken"):
+                break
+            options["$skipToken"] = result["$skipToken"]
+
+
+def concat_disks_chunks(chunks) -> pd.DataFrame:
+    disks_chunks = list(chunks)
+    if not disks_chunks:
+        return pd.DataFrame(columns=DISK_COLUMNS)
+    # Categories differ between chunks, so they are set again on the concatenated frame
+    return pd.concat(disks_chunks, ignore_index=True).astype({column: "category" for column in CATEGORICAL_DISK_COLUMNS})
+
+
+def iter_list_disks_chunks(credential: DefaultAzureCredential, subscription_client: SubscriptionClient, max_workers: int = 8, use_resource_graph: bool = False) -> Iterator[pd.DataFrame]:
+    # Chunks of disks of every subscription the credential can list
+    subscription_ids = [
+        subscription.subscription_id for subscription in subscription_client.subscriptions.list(**get_sdk_operation_kwargs())]
+    if use_resource_graph:
+        return iter_disks_chunks_resource_graph(credential, subscription_ids)
+    return iter_disks_chunks(credential, subscription_ids, max_workers=max_workers)
+
+
+def get_list_disks_df(credential: DefaultAzureCredential, subscription_client: SubscriptionClient, max_workers: int = 8, use_resource_graph: bool = False) -> pd.DataFrame:
+    return concat_disks_chunks(iter_list_disks_chunks(credential, subscription_client, max_workers=max_workers, use_resource_graph=use_resource_graph))
 
 
 def get_tier(disk_size: int, sku_name: str, STANDARD_HDD: dict, STANDARD_SSD: dict, PREMIUM_SSD: dict) -> str:
@@ -59,9 +195,24 @@ def get_tier(disk_size: int, sku_name: str, STANDARD_HDD: dict, STANDARD_SSD: di
         raise ValueError(f"{sku_name} is not a supported disk SKU.")
 
 
-def get_lower_recommended_tier(current_tier: str, throughput: int, IOPS: int, STANDARD_HDD: dict, STANDARD_SSD: dict, minimal_tier: str = "STANDARD_HDD"):
+def get_policy_columns(policy: str = "max") -> tuple:
+    # Names of the throughput and IOPS statistics columns (see timeseries.get_timeseries_stats) used by a sizing policy
+    if policy not in SIZING_POLICIES:
+        raise ValueError(
+            f"{policy} is not a supported sizing policy, allowed values: {', '.join(SIZING_POLICIES)}.")
+    suffix = "" if policy == "max" else f"_{policy}"
+    return f"throughput{suffix}", f"IOPS{suffix}"
+
+
+def get_lower_recommended_tier(current_tier: str, throughput: Union[float, Mapping], IOPS: Union[float, Mapping], STANDARD_HDD: dict, STANDARD_SSD: dict, minimal_tier: str = "STANDARD_HDD", policy: str = "max"):
     # Limit1: burstable Bandwidth and IOPS is not taken into account
     # Limit2: Only lower tiers are considered and not upper tiers
+    # throughput and IOPS are either values or statistics of the disk keyed by column name, the policy one is used
+    throughput_column, IOPS_column = get_policy_columns(policy)
+    if isinstance(throughput, (Mapping, pd.Series)):
+        throughput = throughput[throughput_column]
+    if isinstance(IOPS, (Mapping, pd.Series)):
+        IOPS = IOPS[IOPS_column]
     if current_tier[0] == 'P':
         standard_hdd_tier_equivalent = f"S{max(4, int(current_tier[1:]))}"
         standard_ssd_tier_equivalent = f"E{current_tier[1:]}"
@@ -78,3 +229,69 @@ def get_lower_recommended_tier(current_tier: str, throughput: int, IOPS: int, ST
         else:
             return current_tier
     return current_tier
+
+
+def get_tier_table(disk_skus: dict) -> pd.DataFrame:
+    # One row per tier indexed by tier name, sorted by size within each family so sizes can be binary searched
+    tier_table = pd.DataFrame([{"tier": tier, "family": family, **limits} for family, tiers in disk_skus.items()
+                               for tier, limits in tiers.items()]).set_index("tier")
+    return tier_table.sort_values(["family", "size"], kind="stable")
+
+
+def get_tiers(disk_sizes, sku_names, tier_table: pd.DataFrame) -> np.ndarray:
+    # Vectorized get_tier: smallest tier of the disk family with a size greater or equal to the disk size
+    disk_sizes = np.asarray(disk_sizes, dtype=float)
+    sku_codes = pd.Categorical(
+        sku_names, categories=list(SKU_NAME_FAMILIES)).codes
+    if (sku_codes == -1).any():
+        raise ValueError(
+            f"{np.asarray(sku_names)[sku_codes == -1][0]} is not a supported disk SKU.")
+    tiers = np.empty(len(disk_sizes), dtype=object)
+    for sku_code, family in enumerate(SKU_NAME_FAMILIES.values()):
+        mask = sku_codes == sku_code
+        family_table = tier_table[tier_table.family == family]
+        indexes = np.searchsorted(
+            family_table["size"].to_numpy(), disk_sizes[mask], side="left")
+        tiers[mask] = family_table.index.to_numpy()[np.minimum(
+            indexes, len(family_table) - 1)]
+    return tiers
+
+
+def get_lower_tier_equivalents(tier_table: pd.DataFrame) -> pd.DataFrame:
+    # Same number Standard HDD and Standard SSD tiers considered by get_lower_recommended_tier for each tier
+    equivalents = pd.DataFrame(index=tier_table.index)
+    numbers = tier_table.index.str[1:]
+    equivalents["hdd_tier"] = [f"S{max(4, int(number))}" if tier[0] in "PE" else None for tier,
+                               number in zip(tier_table.index, numbers)]
+    equivalents["ssd_tier"] = [f"E{number}" if tier[0] == "P" else None for tier,
+                               number in zip(tier_table.index, numbers)]
+    return equivalents
+
+
+def get_lower_recommended_tiers(current_tiers, throughput, IOPS, tier_table: pd.DataFrame, minimal_tier: str = "STANDARD_HDD") -> np.ndarray:
+    # Vectorized get_lower_recommended_tier using boolean masks over the throughput and IOPS limits of the equivalent tiers
+    tier_names = tier_table.index.to_numpy()
+    current_codes = pd.Categorical(current_tiers, categories=tier_names).codes
+    throughput = np.asarray(throughput, dtype=float)
+    IOPS = np.asarray(IOPS, dtype=float)
+    equivalents = get_lower_tier_equivalents(tier_table)
+    # -1 marks tiers without an equivalent, limits are appended a NaN entry for it so that comparisons are False
+    throughput_limits = np.append(tier_table.throughput.to_numpy(dtype=float), np.nan)
+    IOPS_limits = np.append(tier_table.IOPS.to_numpy(dtype=float), np.nan)
+    recommended_codes = current_codes.copy()
+    candidates = [("hdd_tier", minimal_tier == "STANDARD_HDD"),
+                  ("ssd_tier", minimal_tier in ("STANDARD_HDD", "STANDARD_SSD"))]
+    # Candidates are applied from the most to the least preferred, so earlier matches are kept
+    decided = current_codes == -1
+    for column, allowed in candidates:
+        if not allowed:
+            continue
+        equivalent_codes = pd.Categorical(
+            equivalents[column], categories=tier_names).codes
+        disks_equivalent_codes = np.where(
+            current_codes == -1, -1, equivalent_codes[current_codes])
+        fits = (throughput <= throughput_limits[disks_equivalent_codes]) & (
+            IOPS <= IOPS_limits[disks_equivalent_codes]) & ~decided
+        recommended_codes[fits] = disks_equivalent_codes[fits]
+        decided |= fits
+    return np.where(recommended_codes == -1, np.asarray(current_tiers, dtype=object), tier_names[recommended_codes])
@@ -1,3 +1,25 @@
+from __future__ import annotations
+import os
+import time
+import random
+import threading
+from typing import TYPE_CHECKING
+from modules.instrumentation import run_report
+if TYPE_CHECKING:
+    import requests
+
+
+MANAGEMENT_SCOPE = "https://management.azure.com/.default"
+# Endpoints can be overridden, e.g. to point at a local stand-in of the Azure APIs for benchmarks
+MANAGEMENT_ENDPOINT = os.environ.get(
+    "AZURE_MANAGEMENT_ENDPOINT", "https://management.azure.com").rstrip("/")
+METRICS_BATCH_ENDPOINT = os.environ.get(
+    "AZURE_METRICS_BATCH_ENDPOINT", "https://{location}.metrics.monitor.azure.com").rstrip("/")
+PRICES_ENDPOINT = os.environ.get(
+    "AZURE_PRICES_ENDPOINT", "https://prices.azure.com").rstrip("/")
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
 def power_of_two(target: int) -> int:
     if target > 1:
         for i in range(1, int(target)):
@@ -5,3 +27,116 @@ def power_of_two(target: int) -> int:
                 return 2 ** i
     else:
         return 1
+
+
+class TokenProvider:
+    # Caches a bearer token and refreshes it shortly before expiry so that long runs do not fail midway
+    def __init__(self, credential, scope: str = MANAGEMENT_SCOPE, refresh_margin_seconds: int = 300):
+        self.credential = credential
+        self.scope = scope
+        self.refresh_margin_seconds = refresh_margin_seconds
+        self._access_token = None
+        self._lock = threading.Lock()
+
+    def get(self) -> str:
+        with self._lock:
+            if self._access_token is None or self._access_token.expires_on - time.time() < self.refresh_margin_seconds:
+                start = time.perf_counter()
+                self._access_token = self.credential.get_token(self.scope)
+                run_report.record_request(
+                    "token", 200, time.perf_counter() - start)
+            return self._access_token.token
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._access_token = None
+
+
+class LazyCredential:
+    # Creates DefaultAzureCredential on the first token request, so that runs served from saved tables never load azure.identity
+    def __init__(self):
+        self._credential = None
+        self._lock = threading.Lock()
+
+    def get_token(self, *scopes, **kwargs):
+        with self._lock:
+            if self._credential is None:
+                from azure.identity import DefaultAzureCredential
+                self._credential = DefaultAzureCredential()
+        return self._credential.get_token(*scopes, **kwargs)
+
+
+def get_sdk_operation_kwargs() -> dict:
+    # Azure SDK clients refuse to send bearer tokens over plain HTTP, which local stand-ins of the management endpoint use
+    return {"enforce_https": False} if MANAGEMENT_ENDPOINT.startswith("http://") else {}
+
+
+def get_sdk_client_kwargs(kind: str) -> dict:
+    # Azure SDK clients retry on their own instead of through request_with_retry, so their azure-core hooks record every attempt in the run report under kind
+    def on_request(request):
+        request.context["run_report_start"] = time.perf_counter()
+
+    def on_response(response):
+        http_response = response.http_response
+        start = response.context.get("run_report_start")
+        run_report.record_request(kind, http_response.status_code, time.perf_counter() - start if start else 0,
+                                  len(http_response.body() or b""))
+        # Throttled and transient errors are retried by the SDK retry policy
+        if http_response.status_code in RETRY_STATUS_CODES:
+            run_report.record_retry(kind)
+
+    return {"raw_request_hook": on_request, "raw_response_hook": on_response}
+
+
+def get_session(pool_size: int = 16) -> requests.Session:
+    # Shared session so that TCP/TLS connections are reused across requests and threads
+    import requests
+    from requests.adapters import HTTPAdapter
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def get_retry_delay(response: requests.Response, attempt: int, max_delay: float = 60) -> float:
+    # Honor Retry-After (in seconds) when Azure provides it, else exponential backoff with jitter
+    retry_after = response.headers.get("Retry-After") if response is not None else None
+    if retry_after is not None:
+        try:
+            return min(float(retry_after), max_delay)
+        except ValueError:
+            pass
+    return min(2 ** attempt, max_delay) + random.uniform(0, 1)
+
+
+def request_with_retry(session: requests.Session, method: str, url: str, max_retries: int = 5, kind: str = "arm", **kwargs) -> requests.Response:
+    # Retries throttled (429) and transient server errors, the last response is returned as is
+    # Every attempt is recorded in the run report under kind, as well as the final failure if any
+    for attempt in range(max_retries + 1):
+        start = time.perf_counter()
+        try:
+            response = session.request(method, url, **kwargs)
+        except Exception:
+            run_report.record_failure(kind)
+            raise
+        run_report.record_request(kind, response.status_code, time.perf_counter(
+        ) - start, len(response.content))
+        if response.status_code not in RETRY_STATUS_CODES or attempt == max_retries:
+            if response.status_code >= 400:
+                run_report.record_failure(kind)
+            return response
+        run_report.record_retry(kind)
+        time.sleep(get_retry_delay(response, attempt))
+    return response
+
+
+def request_with_token(session: requests.Session, method: str, url: str, token: TokenProvider, max_retries: int = 5, kind: str = "arm", **kwargs) -> requests.Response:
+    response = request_with_retry(session, method, url, max_retries=max_retries, kind=kind, headers={
+                                  "Authorization": f"Bearer {token.get()}"}, **kwargs)
+    if response.status_code == 401:
+        # Token expired or was revoked during a long run, get a fresh one and try once more
+        token.invalidate()
+        response = request_with_retry(session, method, url, max_retries=max_retries, kind=kind, headers={
+                                      "Authorization": f"Bearer {token.get()}"}, **kwargs)
+    return response
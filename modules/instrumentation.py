@@ -0,0 +1,114 @@
+import json
+import time
+import threading
+import tracemalloc
+from pathlib import Path
+from datetime import datetime, timezone
+from contextlib import contextmanager
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+
+# Upper bounds (in milliseconds) of the request latency histogram buckets, the last one catching everything above
+LATENCY_BUCKETS_MS = [50, 100, 250, 500, 1000, 2500, 5000, 10000, float("inf")]
+
+
+def get_peak_memory_mb() -> float:
+    if resource is not None:
+        # ru_maxrss is in kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    if tracemalloc.is_tracing():
+        return tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+    return None
+
+
+class RunReport:
+    # Thread safe collection of per stage wall times and per kind of request statistics, dumped as JSON at the end of a run
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self, metadata: dict = None) -> None:
+        with self._lock:
+            self.metadata = metadata or {}
+            self.started_at = datetime.now(timezone.utc).isoformat()
+            self._start = time.perf_counter()
+            self.stages = {}
+            self.requests = {}
+            self.counters = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        # The process peak is a high-water mark, so a stage is reported by how much it raised it (0 when it stayed below an earlier stage)
+        start = time.perf_counter()
+        start_peak_memory_mb = get_peak_memory_mb()
+        try:
+            yield
+        finally:
+            end_peak_memory_mb = get_peak_memory_mb()
+            with self._lock:
+                stage = self.stages.setdefault(
+                    name, {"wall_time_seconds": 0, "calls": 0, "peak_memory_increase_mb": 0})
+                stage["wall_time_seconds"] += time.perf_counter() - start
+                stage["calls"] += 1
+                if start_peak_memory_mb is not None and end_peak_memory_mb is not None:
+                    stage["peak_memory_increase_mb"] = max(
+                        stage["peak_memory_increase_mb"], end_peak_memory_mb - start_peak_memory_mb)
+
+    def _get_request_stats(self, kind: str) -> dict:
+        return self.requests.setdefault(kind, {
+            "count": 0, "failures": 0, "retries": 0, "throttled": 0, "bytes_downloaded": 0, "status_codes": {},
+            "latency_ms_total": 0, "latency_ms_max": 0, "latency_ms_histogram": {str(bucket): 0 for bucket in LATENCY_BUCKETS_MS}})
+
+    def record_request(self, kind: str, status_code: int, latency_seconds: float, bytes_downloaded: int = 0) -> None:
+        latency_ms = latency_seconds * 1000
+        with self._lock:
+            stats = self._get_request_stats(kind)
+            stats["count"] += 1
+            stats["bytes_downloaded"] += bytes_downloaded
+            stats["status_codes"][str(status_code)] = stats["status_codes"].get(
+                str(status_code), 0) + 1
+            if status_code == 429:
+                stats["throttled"] += 1
+            stats["latency_ms_total"] += latency_ms
+            stats["latency_ms_max"] = max(stats["latency_ms_max"], latency_ms)
+            bucket = next(bucket for bucket in LATENCY_BUCKETS_MS if latency_ms <= bucket)
+            stats["latency_ms_histogram"][str(bucket)] += 1
+
+    def record_retry(self, kind: str) -> None:
+        with self._lock:
+            self._get_request_stats(kind)["retries"] += 1
+
+    def record_failure(self, kind: str) -> None:
+        with self._lock:
+            self._get_request_stats(kind)["failures"] += 1
+
+    def increment(self, counter: str, value: float = 1) -> None:
+        with self._lock:
+            self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            requests = {kind: {**stats, "latency_ms_mean": stats["latency_ms_total"] / stats["count"] if stats["count"] else None}
+                        for kind, stats in self.requests.items()}
+            return {
+                "started_at": self.started_at,
+                "metadata": self.metadata,
+                "wall_time_seconds": time.perf_counter() - self._start,
+                "peak_memory_mb": get_peak_memory_mb(),
+                "stages": dict(self.stages),
+                "requests": requests,
+                "counters": dict(self.counters)
+            }
+
+    def save(self, path: str) -> None:
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+
+# Shared by all modules of a run
+run_report = RunReport()
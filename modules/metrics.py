@@ -1,9 +1,23 @@
-import requests
+from __future__ import annotations
 import json
 import numpy as np
-from typing import List
+from typing import TYPE_CHECKING, Iterator, List, Union
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta, timezone
-from requests.exceptions import HTTPError
+from modules.helpers import MANAGEMENT_ENDPOINT, MANAGEMENT_SCOPE, METRICS_BATCH_ENDPOINT, TokenProvider, get_session, request_with_retry, request_with_token
+from modules.instrumentation import run_report
+from modules.metrics_cache import MetricsCache
+from modules.timeseries import TimeseriesStore, get_interval_seconds, parse_disk_timeseries
+if TYPE_CHECKING:
+    import requests
+
+
+METRICS_NAME = "Composite Disk Read Bytes/sec,Composite Disk Read Operations/sec,Composite Disk Write Bytes/sec,Composite Disk Write Operations/sec"
+METRICS_BATCH_SCOPE = "https://metrics.monitor.azure.com/.default"
+# Maximum number of resources accepted by one metrics:getBatch request
+METRICS_BATCH_SIZE = 50
+# Most recent minutes are refetched on the next run as Azure Monitor may not have ingested them yet
+METRICS_INGESTION_DELAY_MINUTES = 10
 
 
 def sum_metrics(timeseries_avg_max_dict, perf_metric: str = "IOPS"):
@@ -27,34 +41,247 @@ def get_timeseries_average_max(timeseries_dict: List[dict]) -> tuple:
     return {"average": timeseries_array.mean(), "maximum": timeseries_array.max()}
 
 
-def get_disk_throughput_IOPS(disk_id: str, token: str, interval_ISO: str = "PT1M", timerange_days: int = 1):
+def get_timespan(timerange_days: int = 1) -> tuple:
     start_date = (datetime.now(timezone.utc) - timedelta(days=timerange_days)
                   ).replace(second=0, microsecond=0).isoformat().split("+")[0] + "Z"
     end_date = datetime.now(timezone.utc).replace(
         second=0, microsecond=0).isoformat().split("+")[0] + "Z"
-    METRICS_NAME = "Composite Disk Read Bytes/sec,Composite Disk Read Operations/sec,Composite Disk Write Bytes/sec,Composite Disk Write Operations/sec"
-    try:
-        response = requests.get(
-            f"https://management.azure.com{disk_id}/providers/Microsoft.Insights/metrics?api-version=2018-01-01&timespan={start_date}/{end_date}&aggregation=Average,maximum&metricnames={METRICS_NAME}&interval={interval_ISO}", headers={"Authorization": f"Bearer {token}"})
+    return start_date, end_date
+
+
+def parse_disk_throughput_IOPS(metrics: dict) -> tuple:
+    timeseries_avg_max = [{"name": x["name"]["value"], "value": get_timeseries_average_max(
+        x["timeseries"])} for i, x in enumerate(metrics["value"])]
+    timeseries_avg_max_dict = {
+        item["name"]: item["value"] for item in timeseries_avg_max}
+    throughput_mbps = sum_metrics(
+        timeseries_avg_max_dict, "throughput_mbps")
+    IOPS = sum_metrics(timeseries_avg_max_dict, "IOPS")
+    if throughput_mbps[1] and IOPS[1]:
+        return throughput_mbps[1], IOPS[1]  # return max values
+    return 0, 0
+
+
+def parse_disk_metrics_buckets(metrics: dict) -> dict:
+    # Maximum of each metric per UTC day, keyed by "YYYY-MM-DD"
+    buckets = {}
+    for metric in metrics["value"]:
+        name = metric["name"]["value"]
+        for timeseries in metric["timeseries"]:
+            for point in timeseries.get("data", []):
+                if point.get("maximum") is None:
+                    continue
+                bucket = buckets.setdefault(point["timeStamp"][:10], {})
+                bucket[name] = max(bucket.get(name, 0), point["maximum"])
+    return buckets
+
+
+def request_disk_metrics(disk_id: str, token: Union[str, TokenProvider], interval_ISO: str = "PT1M", timespan: tuple = None, session: requests.Session = None, max_retries: int = 0) -> dict:
+    import requests
+    start_date, end_date = timespan or get_timespan()
+    session = session or requests
+    url = f"{MANAGEMENT_ENDPOINT}{disk_id}/providers/Microsoft.Insights/metrics?api-version=2018-01-01&timespan={start_date}/{end_date}&aggregation=Average,maximum&metricnames={METRICS_NAME}&interval={interval_ISO}"
+    if isinstance(token, TokenProvider):
+        response = request_with_token(
+            session, "GET", url, token, max_retries=max_retries, kind="metrics")
+    else:
+        response = request_with_retry(session, "GET", url, max_retries=max_retries, kind="metrics", headers={
+                                      "Authorization": f"Bearer {token}"})
+    # If the response was successful, no Exception will be raised
+    response.raise_for_status()
+    return json.loads(response.content)
+
+
+def request_batch_metrics(subscription_id: str, location: str, disk_ids: List[str], token: TokenProvider, interval_ISO: str = "PT1M", timespan: tuple = None, session: requests.Session = None, max_retries: int = 0) -> List[dict]:
+    import requests
+    start_date, end_date = timespan or get_timespan()
+    session = session or requests
+    url = f"{METRICS_BATCH_ENDPOINT.format(location=location)}/subscriptions/{subscription_id}/metrics:getBatch?api-version=2023-10-01&starttime={start_date}&endtime={end_date}&interval={interval_ISO}&aggregation=average,maximum&metricnamespace=Microsoft.Compute/disks&metricnames={METRICS_NAME}"
+    response = request_with_token(session, "POST", url, token, max_retries=max_retries, kind="metrics_batch", json={
+                                  "resourceids": disk_ids})
+    response.raise_for_status()
+    return json.loads(response.content).get("values", [])
 
-        # If the response was successful, no Exception will be raised
-        response.raise_for_status()
 
+def get_disk_throughput_IOPS(disk_id: str, token: Union[str, TokenProvider], interval_ISO: str = "PT1M", timerange_days: int = 1, session: requests.Session = None, max_retries: int = 0, timespan: tuple = None):
+    from requests.exceptions import HTTPError
+    try:
+        metrics = request_disk_metrics(disk_id, token, interval_ISO=interval_ISO, timespan=timespan or get_timespan(
+            timerange_days), session=session, max_retries=max_retries)
     except HTTPError as http_err:
         print(f'HTTP error occurred: {http_err}')  # Python 3.10
         return 0, 0
     except Exception as err:
         print(f'Other error occurred: {err}')  # Python 3.10
         return 0, 0
-    else:
-        metrics = json.loads(response.content)
-        timeseries_avg_max = [{"name": x["name"]["value"], "value": get_timeseries_average_max(
-            x["timeseries"])} for i, x in enumerate(metrics["value"])]
-        timeseries_avg_max_dict = {
-            item["name"]: item["value"] for item in timeseries_avg_max}
-        throughput_mbps = sum_metrics(
-            timeseries_avg_max_dict, "throughput_mbps")
-        IOPS = sum_metrics(timeseries_avg_max_dict, "IOPS")
-        if throughput_mbps[1] and IOPS[1]:
-            return throughput_mbps[1], IOPS[1]  # return max values
+    try:
+        return parse_disk_throughput_IOPS(metrics)
+    except Exception as err:
+        run_report.increment("metrics_parse_errors")
+        print(f'Error parsing metrics of {disk_id}: {err}')
         return 0, 0
+
+
+def get_disks_throughput_IOPS(disk_ids: List[str], credential, interval_ISO: str = "PT1M", timerange_days: int = 1, max_workers: int = 16, max_retries: int = 5) -> List[dict]:
+    # Fetch metrics for many disks concurrently with a shared connection pool and a refreshing token
+    from tqdm import tqdm
+    token_provider = TokenProvider(credential)
+    session = get_session(pool_size=max_workers)
+    # Same timespan for every disk so that results are comparable across the fleet
+    timespan = get_timespan(timerange_days)
+    list_disks_throughput_IOPS = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(get_disk_throughput_IOPS, disk_id, token_provider, interval_ISO=interval_ISO,
+                                   session=session, max_retries=max_retries, timespan=timespan): disk_id for disk_id in disk_ids}
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Getting disk throughput and IOPS..."):
+            throughput, IOPS = future.result()
+            list_disks_throughput_IOPS.append({
+                "id": futures[future],
+                "throughput": throughput,
+                "IOPS": IOPS
+            })
+    session.close()
+    return list_disks_throughput_IOPS
+
+
+def get_metrics_batches(disk_ids: List[str], locations: List[str], batch_size: int = METRICS_BATCH_SIZE) -> List[tuple]:
+    # The batch API only accepts resources from the same subscription and region in one request
+    groups = {}
+    for disk_id, location in zip(disk_ids, locations):
+        groups.setdefault((disk_id.split('/')[2], location.lower()), []).append(disk_id)
+    return [(subscription_id, location, ids[i:i + batch_size]) for (subscription_id, location), ids in groups.items() for i in range(0, len(ids), batch_size)]
+
+
+def get_batch_throughput_IOPS(subscription_id: str, location: str, disk_ids: List[str], token: TokenProvider, interval_ISO: str = "PT1M", timespan: tuple = None, session: requests.Session = None, max_retries: int = 0) -> dict:
+    from requests.exceptions import HTTPError
+    disks_throughput_IOPS = {disk_id.lower(): (0, 0) for disk_id in disk_ids}
+    try:
+        batch_metrics = request_batch_metrics(subscription_id, location, disk_ids, token, interval_ISO=interval_ISO,
+                                              timespan=timespan, session=session, max_retries=max_retries)
+    except HTTPError as http_err:
+        print(f'HTTP error occurred: {http_err}')
+        return disks_throughput_IOPS
+    except Exception as err:
+        print(f'Other error occurred: {err}')
+        return disks_throughput_IOPS
+    for resource_metrics in batch_metrics:
+        try:
+            disks_throughput_IOPS[resource_metrics["resourceid"].lower()] = parse_disk_throughput_IOPS(
+                resource_metrics)
+        except Exception as err:
+            run_report.increment("metrics_parse_errors")
+            print(
+                f'Error parsing metrics of {resource_metrics.get("resourceid")}: {err}')
+    return disks_throughput_IOPS
+
+
+def get_disks_throughput_IOPS_batch(disk_ids: List[str], locations: List[str], credential, interval_ISO: str = "PT1M", timerange_days: int = 1, max_workers: int = 4, max_retries: int = 5, batch_size: int = METRICS_BATCH_SIZE) -> List[dict]:
+    # Same output as get_disks_throughput_IOPS but with one request per batch of disks
+    from tqdm import tqdm
+    token_provider = TokenProvider(credential, scope=METRICS_BATCH_SCOPE)
+    session = get_session(pool_size=max_workers)
+    timespan = get_timespan(timerange_days)
+    batches = get_metrics_batches(disk_ids, locations, batch_size)
+    disks_throughput_IOPS = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(get_batch_throughput_IOPS, subscription_id, location, batch, token_provider, interval_ISO=interval_ISO,
+                                   timespan=timespan, session=session, max_retries=max_retries) for subscription_id, location, batch in batches]
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Getting disk throughput and IOPS in batches..."):
+            disks_throughput_IOPS.update(future.result())
+    session.close()
+    list_disks_throughput_IOPS = []
+    for disk_id in disk_ids:
+        throughput, IOPS = disks_throughput_IOPS.get(disk_id.lower(), (0, 0))
+        list_disks_throughput_IOPS.append({
+            "id": disk_id,
+            "throughput": throughput,
+            "IOPS": IOPS
+        })
+    return list_disks_throughput_IOPS
+
+
+def submit_metrics_requests(executor: ThreadPoolExecutor, missing_starts: dict, locations: dict, end_date: str, token: TokenProvider, interval_ISO: str = "PT1M", session: requests.Session = None, max_retries: int = 5, batch: bool = False) -> dict:
+    # One request per disk, or per batch of disks sharing subscription, region and start date, keyed by future
+    if not batch:
+        return {executor.submit(request_disk_metrics, disk_id, token, interval_ISO=interval_ISO, timespan=(missing_start, end_date), session=session, max_retries=max_retries): (missing_start, [disk_id])
+                for disk_id, missing_start in missing_starts.items()}
+    disks_by_start = {}
+    for disk_id, missing_start in missing_starts.items():
+        disks_by_start.setdefault(missing_start, []).append(disk_id)
+    return {executor.submit(request_batch_metrics, subscription_id, location, batch_ids, token, interval_ISO=interval_ISO, timespan=(missing_start, end_date), session=session, max_retries=max_retries): (missing_start, batch_ids)
+            for missing_start, start_ids in disks_by_start.items() for subscription_id, location, batch_ids in get_metrics_batches(start_ids, [locations[disk_id] for disk_id in start_ids])}
+
+
+def iter_metrics_results(futures: dict, batch: bool = False, desc: str = "Getting disk throughput and IOPS...") -> Iterator[tuple]:
+    # (start_date, disk_id, metrics) of every disk as requests complete, failed requests are reported and skipped
+    from tqdm import tqdm
+    for future in tqdm(as_completed(futures), total=len(futures), desc=desc):
+        missing_start, future_disk_ids = futures[future]
+        try:
+            result = future.result()
+        except Exception as err:
+            print(f'Error occurred getting metrics: {err}')
+            continue
+        if not batch:
+            yield missing_start, future_disk_ids[0], result
+            continue
+        cased_disk_ids = {disk_id.lower(): disk_id for disk_id in future_disk_ids}
+        for resource_metrics in result:
+            disk_id = cased_disk_ids.get(str(resource_metrics.get("resourceid", "")).lower())
+            if disk_id is not None:
+                yield missing_start, disk_id, resource_metrics
+
+
+def get_disks_throughput_IOPS_incremental(disk_ids: List[str], locations: List[str], credential, cache: MetricsCache, interval_ISO: str = "PT1M", timerange_days: int = 1, max_workers: int = 16, max_retries: int = 5, batch: bool = False) -> List[dict]:
+    # Only fetch the part of the time range that is not in the cache yet, then aggregate from the cache
+    start_date, end_date = get_timespan(timerange_days)
+    fetched_until = (datetime.strptime(end_date, "%Y-%m-%dT%H:%M:%SZ") - timedelta(
+        minutes=METRICS_INGESTION_DELAY_MINUTES)).strftime("%Y-%m-%dT%H:%M:%SZ")
+    missing_starts = cache.get_missing_starts(
+        disk_ids, start_date, fetched_until)
+    print(
+        f"{len(missing_starts)} out of {len(disk_ids)} disks have metrics missing from the cache.")
+    token_provider = TokenProvider(
+        credential, scope=METRICS_BATCH_SCOPE if batch else MANAGEMENT_SCOPE)
+    session = get_session(pool_size=max_workers)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = submit_metrics_requests(executor, missing_starts, dict(zip(disk_ids, locations)), end_date, token_provider,
+                                          interval_ISO=interval_ISO, session=session, max_retries=max_retries, batch=batch)
+        # Writes stay on this thread as the SQLite connection is not shared with the workers, failed disks are fetched on the next run
+        for missing_start, disk_id, metrics in iter_metrics_results(futures, batch=batch, desc="Getting missing disk throughput and IOPS..."):
+            try:
+                buckets = parse_disk_metrics_buckets(metrics)
+            except Exception as err:
+                # Left out of the cache, so that the next run fetches it again
+                run_report.increment("metrics_parse_errors")
+                print(f'Error parsing metrics of {disk_id}: {err}')
+                continue
+            cache.update(disk_id, buckets, missing_start, fetched_until)
+    session.close()
+    return cache.get_throughput_IOPS(disk_ids, start_date)
+
+
+def get_disks_timeseries(disk_ids: List[str], locations: List[str], credential, store: TimeseriesStore, interval_ISO: str = "PT1M", timerange_days: int = 1, max_workers: int = 16, max_retries: int = 5, batch: bool = False) -> None:
+    # Keep the full throughput and IOPS series of every disk in a memory-mappable store instead of only their maximum
+    start_date, end_date = get_timespan(timerange_days)
+    interval_seconds = get_interval_seconds(interval_ISO)
+    n_points = int((datetime.strptime(end_date, "%Y-%m-%dT%H:%M:%SZ") - datetime.strptime(
+        start_date, "%Y-%m-%dT%H:%M:%SZ")).total_seconds() // interval_seconds)
+    throughput, IOPS = store.create(
+        disk_ids, start_date, interval_seconds, n_points)
+    rows = {disk_id: row for row, disk_id in enumerate(disk_ids)}
+    token_provider = TokenProvider(
+        credential, scope=METRICS_BATCH_SCOPE if batch else MANAGEMENT_SCOPE)
+    session = get_session(pool_size=max_workers)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = submit_metrics_requests(executor, {disk_id: start_date for disk_id in disk_ids}, dict(zip(disk_ids, locations)), end_date, token_provider,
+                                          interval_ISO=interval_ISO, session=session, max_retries=max_retries, batch=batch)
+        for _, disk_id, metrics in iter_metrics_results(futures, batch=batch, desc="Getting disk throughput and IOPS time series..."):
+            try:
+                throughput[rows[disk_id]], IOPS[rows[disk_id]] = parse_disk_timeseries(
+                    metrics, start_date, interval_seconds, n_points)
+            except Exception as err:
+                run_report.increment("metrics_parse_errors")
+                print(f'Error parsing metrics of {disk_id}: {err}')
+    session.close()
+    store.close()
@@ -0,0 +1,105 @@
+import sqlite3
+from pathlib import Path
+from typing import List
+from datetime import datetime, timedelta
+
+
+METRIC_COLUMNS = {
+    "Composite Disk Read Bytes/sec": "read_bytes",
+    "Composite Disk Write Bytes/sec": "write_bytes",
+    "Composite Disk Read Operations/sec": "read_ops",
+    "Composite Disk Write Operations/sec": "write_ops"
+}
+
+
+def get_buckets(start_date: str, end_date: str) -> List[tuple]:
+    # One bucket per UTC day overlapping [start_date, end_date], as (bucket, bucket_start, bucket_end) ISO strings
+    day = datetime.strptime(start_date[:10], "%Y-%m-%d")
+    last_day = datetime.strptime(end_date[:10], "%Y-%m-%d")
+    buckets = []
+    while day <= last_day:
+        next_day = day + timedelta(days=1)
+        buckets.append((day.strftime("%Y-%m-%d"), day.strftime("%Y-%m-%dT%H:%M:%SZ"),
+                       next_day.strftime("%Y-%m-%dT%H:%M:%SZ")))
+        day = next_day
+    return buckets
+
+
+class MetricsCache:
+    # Per disk and per UTC day maxima of the Composite Disk metrics, stored in SQLite so that runs only fetch what is missing
+    def __init__(self, path: str = "data/metrics_cache.sqlite"):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(f"""CREATE TABLE IF NOT EXISTS disk_metrics (
+            disk_id TEXT NOT NULL,
+            bucket TEXT NOT NULL,
+            {", ".join(f"{column} REAL" for column in METRIC_COLUMNS.values())},
+            fetched_from TEXT NOT NULL,
+            fetched_until TEXT NOT NULL,
+            PRIMARY KEY (disk_id, bucket))""")
+        self.connection.commit()
+
+    def get_missing_starts(self, disk_ids: List[str], start_date: str, end_date: str) -> dict:
+        # Start of the range to fetch for every disk missing part of [start_date, end_date], disks fully cached are left out
+        buckets = get_buckets(start_date, end_date)
+        cached = {}
+        for disk_id, bucket, fetched_from, fetched_until in self.connection.execute(
+                "SELECT disk_id, bucket, fetched_from, fetched_until FROM disk_metrics WHERE bucket >= ?", (buckets[0][0],)):
+            cached[(disk_id, bucket)] = (fetched_from, fetched_until)
+        missing_starts = {}
+        for disk_id in disk_ids:
+            for bucket, bucket_start, bucket_end in buckets:
+                required_from, required_until = max(
+                    bucket_start, start_date), min(bucket_end, end_date)
+                fetched_from, fetched_until = cached.get(
+                    (disk_id, bucket), (None, None))
+                if fetched_from is None or fetched_from > required_from:
+                    missing_starts[disk_id] = required_from
+                    break
+                if fetched_until < required_until:
+                    missing_starts[disk_id] = fetched_until
+                    break
+        return missing_starts
+
+    def update(self, disk_id: str, buckets_metrics: dict, start_date: str, end_date: str) -> None:
+        # Merge the maxima fetched for [start_date, end_date] with the cached ones, buckets without data are stored too
+        rows = []
+        for bucket, bucket_start, bucket_end in get_buckets(start_date, end_date):
+            metrics = buckets_metrics.get(bucket, {})
+            rows.append((disk_id, bucket, *[metrics.get(name) for name in METRIC_COLUMNS],
+                         max(bucket_start, start_date), min(bucket_end, end_date)))
+        merge_columns = ", ".join(
+            f"{column} = max(coalesce({column}, excluded.{column}), coalesce(excluded.{column}, {column}))" for column in METRIC_COLUMNS.values())
+        self.connection.executemany(f"""INSERT INTO disk_metrics VALUES ({", ".join("?" * (len(METRIC_COLUMNS) + 4))})
+            ON CONFLICT (disk_id, bucket) DO UPDATE SET {merge_columns},
+            fetched_from = min(fetched_from, excluded.fetched_from),
+            fetched_until = max(fetched_until, excluded.fetched_until)""", rows)
+        # Commit per disk so that an interrupted run resumes where it stopped
+        self.connection.commit()
+
+    def get_throughput_IOPS(self, disk_ids: List[str], start_date: str) -> List[dict]:
+        # Whole days are aggregated, so the first day of the time range is always fully included
+        maxima = {}
+        for disk_id, read_bytes, write_bytes, read_ops, write_ops in self.connection.execute(
+                "SELECT disk_id, max(read_bytes), max(write_bytes), max(read_ops), max(write_ops) FROM disk_metrics WHERE bucket >= ? GROUP BY disk_id", (start_date[:10],)):
+            maxima[disk_id] = ((read_bytes or 0) + (write_bytes or 0)) / \
+                (1024 * 1024), (read_ops or 0) + (write_ops or 0)
+        list_disks_throughput_IOPS = []
+        for disk_id in disk_ids:
+            throughput, IOPS = maxima.get(disk_id, (0, 0))
+            if not (throughput and IOPS):
+                throughput, IOPS = 0, 0
+            list_disks_throughput_IOPS.append({
+                "id": disk_id,
+                "throughput": throughput,
+                "IOPS": IOPS
+            })
+        return list_disks_throughput_IOPS
+
+    def prune(self, before_date: str) -> None:
+        self.connection.execute(
+            "DELETE FROM disk_metrics WHERE bucket < ?", (before_date[:10],))
+        self.connection.commit()
+
+    def close(self) -> None:
+        self.connection.close()
@@ -0,0 +1,171 @@
+import numpy as np
+import pandas as pd
+from modules.compute import get_tiers
+from modules.pricing import HOURS_PER_MONTH, OPERATIONS_BILLING_UNIT, get_indexed_candidates_pricing, get_indexed_premium_v2_pricing
+
+
+# Family and redundancy of every disk SKU name considered, disks keep their redundancy (a ZRS disk is only moved to ZRS SKUs)
+SKU_NAMES = {
+    "Standard_LRS": ("STANDARD_HDD", "LRS"),
+    "StandardSSD_LRS": ("STANDARD_SSD", "LRS"),
+    "StandardSSD_ZRS": ("STANDARD_SSD", "ZRS"),
+    "Premium_LRS": ("PREMIUM_SSD", "LRS"),
+    "Premium_ZRS": ("PREMIUM_SSD", "ZRS"),
+    "PremiumV2_LRS": ("PREMIUM_SSD_V2", "LRS")
+}
+REDUNDANCIES = ["LRS", "ZRS"]
+# minimal_tier excludes the families ranked below it, as in get_lower_recommended_tier
+FAMILY_RANKS = {"STANDARD_HDD": 0, "STANDARD_SSD": 1,
+                "PREMIUM_SSD": 2, "PREMIUM_SSD_V2": 2}
+# Premium SSD v2 has no tiers, its size, IOPS and throughput are provisioned independently within these limits
+PREMIUM_V2_TIER = "PV2"
+PREMIUM_V2_BASELINE_IOPS = 3000
+PREMIUM_V2_BASELINE_THROUGHPUT = 125
+PREMIUM_V2_MAX_IOPS = 80000
+PREMIUM_V2_MAX_THROUGHPUT = 1200
+PREMIUM_V2_MAX_SIZE = 65536
+PREMIUM_V2_IOPS_PER_GB = 500
+PREMIUM_V2_THROUGHPUT_PER_IOPS = 0.25
+# Rows of disks priced at once against all candidates, to bound the memory of the disk x candidate matrices
+CANDIDATES_CHUNK_SIZE = 8192
+
+
+def get_candidates(tier_table: pd.DataFrame) -> pd.DataFrame:
+    # Every tier of every SKU name with its limits, Premium SSD v2 excluded as it is sized separately
+    candidates = [{"sku_name": sku_name, "tier": tier, "family": family, "redundancy": redundancy, "size": limits["size"], "IOPS": limits["IOPS"], "throughput": limits["throughput"]}
+                  for sku_name, (family, redundancy) in SKU_NAMES.items() for tier, limits in tier_table[tier_table.family == family].iterrows()]
+    return pd.DataFrame(candidates)
+
+
+def get_premium_v2_provisioning(disk_sizes, throughput, IOPS) -> tuple:
+    # Smallest size (GiB), IOPS and throughput (MB/s) of a Premium SSD v2 disk serving the load, and whether it is within the limits
+    provisioned_throughput = np.maximum(
+        np.ceil(throughput), PREMIUM_V2_BASELINE_THROUGHPUT)
+    provisioned_IOPS = np.maximum(np.maximum(np.ceil(IOPS), PREMIUM_V2_BASELINE_IOPS), np.ceil(
+        provisioned_throughput / PREMIUM_V2_THROUGHPUT_PER_IOPS))
+    provisioned_sizes = np.maximum(np.ceil(disk_sizes), np.where(
+        provisioned_IOPS > PREMIUM_V2_BASELINE_IOPS, np.ceil(provisioned_IOPS / PREMIUM_V2_IOPS_PER_GB), 1))
+    feasible = (provisioned_IOPS <= PREMIUM_V2_MAX_IOPS) & (
+        provisioned_throughput <= PREMIUM_V2_MAX_THROUGHPUT) & (provisioned_sizes <= PREMIUM_V2_MAX_SIZE)
+    return provisioned_sizes, provisioned_IOPS, provisioned_throughput, feasible
+
+
+def get_premium_v2_costs(provisioned_sizes, provisioned_IOPS, provisioned_throughput, pricing: np.ndarray) -> np.ndarray:
+    # pricing has one row per disk of monthly GiB, IOPS and MB/s prices, baseline IOPS and throughput are free
+    return provisioned_sizes * pricing[:, 0] + np.maximum(provisioned_IOPS - PREMIUM_V2_BASELINE_IOPS, 0) * pricing[:, 1] + \
+        np.maximum(provisioned_throughput -
+                   PREMIUM_V2_BASELINE_THROUGHPUT, 0) * pricing[:, 2]
+
+
+def get_cheapest_recommendations(disks_df: pd.DataFrame, throughput, IOPS, iops, tier_table: pd.DataFrame, price_index: dict, minimal_tier: str = "STANDARD_HDD",
+                                 allow_premium_v2: bool = True) -> pd.DataFrame:
+    # Cheapest SKU and size (fixed and estimated variable cost) with capacity, throughput and IOPS limits above the disk size and statistics,
+    # searched over a disk x candidate cost matrix. Disks without any candidate keep their current SKU.
+    # Same columns as estimate_costs, plus the recommended SKU name, size and provisioned limits
+    sku_codes = pd.Categorical(
+        disks_df.sku_name, categories=list(SKU_NAMES)).codes
+    if (sku_codes == -1).any():
+        raise ValueError(
+            f"{np.asarray(disks_df.sku_name)[sku_codes == -1][0]} is not a supported disk SKU.")
+    if minimal_tier not in FAMILY_RANKS:
+        raise ValueError(
+            f"{minimal_tier} is not a supported minimal tier, allowed values: {', '.join(FAMILY_RANKS)}.")
+    families, redundancies = zip(*SKU_NAMES.values())
+    disk_redundancy_codes = pd.Categorical(np.asarray(redundancies)[
+        sku_codes], categories=REDUNDANCIES).codes
+    is_premium_v2 = np.asarray(families)[sku_codes] == "PREMIUM_SSD_V2"
+    disk_sizes = disks_df.disk_size_gb.to_numpy(dtype=float)
+    throughput = np.asarray(throughput, dtype=float)
+    IOPS = np.asarray(IOPS, dtype=float)
+    monthly_operations = np.asarray(
+        iops, dtype=float) / OPERATIONS_BILLING_UNIT * HOURS_PER_MONTH * 3600
+    locations = pd.Categorical(disks_df.location.astype(str))
+    location_codes = locations.codes
+
+    candidates = get_candidates(tier_table)
+    fixed_pricing, variable_pricing = get_indexed_candidates_pricing(
+        candidates.tier.tolist(), candidates.redundancy.tolist(), list(locations.categories), price_index)
+    candidate_sizes, candidate_IOPS, candidate_throughput = [
+        candidates[column].to_numpy(dtype=float) for column in ("size", "IOPS", "throughput")]
+    candidate_redundancy_codes = pd.Categorical(
+        candidates.redundancy, categories=REDUNDANCIES).codes
+    candidate_allowed = candidates.family.map(FAMILY_RANKS).to_numpy() >= FAMILY_RANKS[minimal_tier]
+
+    # Premium SSD v2 is one more candidate per disk, provisioned to the disk load, and only offered to LRS disks
+    disks_premium_v2_pricing = get_indexed_premium_v2_pricing(
+        list(locations.categories), price_index)[location_codes]
+    premium_v2_sizes, premium_v2_IOPS, premium_v2_throughput, premium_v2_feasible = get_premium_v2_provisioning(
+        disk_sizes, throughput, IOPS)
+    premium_v2_costs = get_premium_v2_costs(
+        premium_v2_sizes, premium_v2_IOPS, premium_v2_throughput, disks_premium_v2_pricing)
+    premium_v2_allowed = allow_premium_v2 and FAMILY_RANKS["PREMIUM_SSD_V2"] >= FAMILY_RANKS[minimal_tier]
+    premium_v2_costs[~(premium_v2_feasible & premium_v2_allowed & (
+        disk_redundancy_codes == REDUNDANCIES.index("LRS")))] = np.nan
+
+    # Current tier and position among the candidates, Premium SSD v2 disks are priced from their provisioned limits
+    family_LRS_sku_names = {family: sku_name for sku_name, (
+        family, redundancy) in SKU_NAMES.items() if redundancy == "LRS" and family != "PREMIUM_SSD_V2"}
+    current_tiers = get_tiers(disk_sizes, np.where(is_premium_v2, "Premium_LRS", [family_LRS_sku_names.get(
+        family) for family in np.asarray(families)[sku_codes]]), tier_table)
+    current_tiers[is_premium_v2] = PREMIUM_V2_TIER
+    current_positions = pd.MultiIndex.from_frame(candidates[["sku_name", "tier"]]).get_indexer(
+        pd.MultiIndex.from_arrays([disks_df.sku_name.astype(str), current_tiers]))
+    current_fixed_pricing = np.where(
+        current_positions == -1, np.nan, fixed_pricing[location_codes, current_positions])
+    current_variable_pricing = np.where(
+        current_positions == -1, np.nan, variable_pricing[location_codes, current_positions])
+    current_fixed_pricing[is_premium_v2] = get_premium_v2_costs(disks_df.disk_size_gb.to_numpy(dtype=float)[is_premium_v2], disks_df.disk_iops_read_write.to_numpy(
+        dtype=float)[is_premium_v2], disks_df.disk_m_bps_read_write.to_numpy(dtype=float)[is_premium_v2], disks_premium_v2_pricing[is_premium_v2])
+    current_variable_pricing[is_premium_v2] = 0
+
+    # Position of the cheapest candidate of every disk, len(candidates) standing for Premium SSD v2 and -1 for no candidate
+    best_positions = np.full(len(disks_df), -1)
+    for start in range(0, len(disks_df), CANDIDATES_CHUNK_SIZE):
+        rows = slice(start, start + CANDIDATES_CHUNK_SIZE)
+        chunk_location_codes = location_codes[rows]
+        costs = fixed_pricing[chunk_location_codes] + \
+            monthly_operations[rows, None] * \
+            variable_pricing[chunk_location_codes]
+        fits = (candidate_sizes >= disk_sizes[rows, None]) & (candidate_IOPS >= IOPS[rows, None]) & (candidate_throughput >= throughput[rows, None]) & (
+            candidate_redundancy_codes == disk_redundancy_codes[rows, None]) & candidate_allowed
+        costs = np.hstack([np.where(fits, costs, np.nan),
+                          premium_v2_costs[rows, None]])
+        has_candidate = ~np.isnan(costs).all(axis=1)
+        best_positions[rows][has_candidate] = np.nanargmin(
+            costs[has_candidate], axis=1)
+
+    is_candidate = (best_positions >= 0) & (best_positions < len(candidates))
+    is_recommended_premium_v2 = best_positions == len(candidates)
+    candidate_positions = np.where(is_candidate, best_positions, 0)
+    recommended = {
+        "tier": np.where(is_candidate, candidates.tier.to_numpy(dtype=object)[candidate_positions], current_tiers),
+        "sku_name": np.where(is_candidate, candidates.sku_name.to_numpy(dtype=object)[candidate_positions], disks_df.sku_name.astype(str).to_numpy(dtype=object)),
+        "size_gb": np.where(is_candidate, candidate_sizes[candidate_positions], disk_sizes),
+        "IOPS": np.where(is_candidate, candidate_IOPS[candidate_positions], disks_df.disk_iops_read_write.to_numpy(dtype=float)),
+        "throughput": np.where(is_candidate, candidate_throughput[candidate_positions], disks_df.disk_m_bps_read_write.to_numpy(dtype=float)),
+        "fixed_pricing": np.where(is_candidate, fixed_pricing[location_codes, candidate_positions], current_fixed_pricing),
+        "variable_pricing": np.where(is_candidate, variable_pricing[location_codes, candidate_positions], current_variable_pricing)
+    }
+    recommended["tier"][is_recommended_premium_v2] = PREMIUM_V2_TIER
+    recommended["sku_name"][is_recommended_premium_v2] = "PremiumV2_LRS"
+    for column, values in (("size_gb", premium_v2_sizes), ("IOPS", premium_v2_IOPS), ("throughput", premium_v2_throughput), ("fixed_pricing", premium_v2_costs)):
+        recommended[column][is_recommended_premium_v2] = values[is_recommended_premium_v2]
+    recommended["variable_pricing"][is_recommended_premium_v2] = 0
+    return pd.DataFrame({
+        "id": disks_df.id.to_numpy(),
+        "current_tier": current_tiers,
+        "recommended_tier": recommended["tier"],
+        "location": disks_df.location.astype(str).to_numpy(),
+        "iops": np.asarray(iops),
+        "current_fixed_pricing": current_fixed_pricing,
+        "current_variable_pricing": current_variable_pricing,
+        "recommended_fixed_pricing": recommended["fixed_pricing"],
+        "recommended_variable_pricing": recommended["variable_pricing"],
+        "estimated_current_variable_pricing": monthly_operations * current_variable_pricing,
+        "estimated_recommended_variable_pricing": monthly_operations * recommended["variable_pricing"],
+        "current_sku_name": disks_df.sku_name.astype(str).to_numpy(),
+        "recommended_sku_name": recommended["sku_name"],
+        "recommended_size_gb": recommended["size_gb"],
+        "recommended_IOPS": recommended["IOPS"],
+        "recommended_throughput": recommended["throughput"]
+    })
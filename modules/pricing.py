@@ -1,29 +1,159 @@
+from __future__ import annotations
 import json
-import requests
+import time
+import numpy as np
 import pandas as pd
+from typing import TYPE_CHECKING, List
 from operator import itemgetter
 from pathlib import Path
 from datetime import date
+from modules.helpers import PRICES_ENDPOINT, get_session, request_with_retry
+if TYPE_CHECKING:
+    import requests
+
+
+# Disk operations are billed per 10k, estimated from IOPS sustained over a 720 hours month
+HOURS_PER_MONTH = 720
+OPERATIONS_BILLING_UNIT = 10000
+COST_COLUMNS = ["current_fixed_pricing", "estimated_current_variable_pricing",
+                "recommended_fixed_pricing", "estimated_recommended_variable_pricing"]
+DISK_PRODUCT_NAMES = ["Standard HDD Managed Disks",
+                      "Standard SSD Managed Disks", "Premium SSD Managed Disks", "Azure Premium SSD v2"]
+# Premium SSD v2 is billed per hour for its provisioned capacity (GiB), IOPS and throughput (MB/s)
+PREMIUM_V2_METERS = ["Provisioned Capacity",
+                     "Provisioned IOPS", "Provisioned Throughput (MBps)"]
 
 
 def get_pricing_REST_filters(location: str, tier: str, redundancy: str = "LRS"):
     sku_name = f"{tier} {redundancy}"
+    return get_price_sheet_REST_filters(location) + f" and skuName eq '{sku_name}'"
+
+
+def get_price_sheet_REST_filters(location: str):
     disk_type_filter = " or ".join(
-        [
-            "productName eq 'Standard HDD Managed Disks'",
-            "productName eq 'Standard SSD Managed Disks'",
-            "productName eq 'Premium SSD Managed Disks'"
-        ]
-    )
+        [f"productName eq '{product_name}'" for product_name in DISK_PRODUCT_NAMES])
     filters = {
         "armRegionName": location
     }
-    return " and ".join([f"{key} eq '{value}'" for key, value in filters.items()]) + f" and ({disk_type_filter})" + f" and skuName eq '{sku_name}'"
+    return " and ".join([f"{key} eq '{value}'" for key, value in filters.items()]) + f" and ({disk_type_filter})"
+
+
+def download_price_sheet(location: str, session: requests.Session = None) -> List[dict]:
+    # All managed disk prices of a region, following NextPageLink until the last page
+    session = session or get_session()
+    retail_prices = []
+    url = f"{PRICES_ENDPOINT}/api/retail/prices?$filter={get_price_sheet_REST_filters(location)}"
+    while url:
+        response = request_with_retry(session, "GET", url, kind="prices")
+        response.raise_for_status()
+        page = json.loads(response.content)
+        retail_prices.extend(page.get("Items", []))
+        url = page.get("NextPageLink")
+    return retail_prices
+
+
+def get_price_sheet_path(location: str, cache_dir: str = "data/prices") -> Path:
+    return Path(cache_dir) / f"{location}.json"
+
+
+def is_price_sheet_cached(location: str, cache_dir: str = "data/prices", ttl_hours: float = 24) -> bool:
+    path = get_price_sheet_path(location, cache_dir)
+    return path.is_file() and time.time() - path.stat().st_mtime < ttl_hours * 3600
+
+
+def load_price_sheet(location: str, cache_dir: str = "data/prices", ttl_hours: float = 24, session: requests.Session = None) -> List[dict]:
+    # Price sheet of a region from the local cache if younger than ttl_hours, downloaded and cached otherwise
+    path = get_price_sheet_path(location, cache_dir)
+    if is_price_sheet_cached(location, cache_dir, ttl_hours):
+        with open(path, "r") as f:
+            return json.load(f)
+    # The session, and requests with it, is only created when the sheet has to be downloaded
+    own_session = session is None
+    session = session or get_session()
+    try:
+        retail_prices = download_price_sheet(location, session=session)
+    finally:
+        if own_session:
+            session.close()
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(retail_prices, f)
+    return retail_prices
+
+
+def build_price_index(retail_prices: List[dict]) -> dict:
+    # First price seen for each key wins, same as the list.index lookup of get_tier_pricing
+    price_index = {}
+    for item in retail_prices:
+        price_index.setdefault(itemgetter("meterName", "skuName", "armRegionName", "type")(
+            item), item["retailPrice"])
+    return price_index
+
+
+def load_price_index(locations: List[str], cache_dir: str = "data/prices", ttl_hours: float = 24) -> dict:
+    locations = sorted(set(locations))
+    # Progress is only shown, and tqdm imported, when some price sheets have to be downloaded
+    if not all(is_price_sheet_cached(location, cache_dir, ttl_hours) for location in locations):
+        from tqdm import tqdm
+        locations = tqdm(locations, desc="Loading regional price sheets...")
+    price_index = {}
+    for location in locations:
+        price_index.update(build_price_index(load_price_sheet(
+            location, cache_dir=cache_dir, ttl_hours=ttl_hours)))
+    return price_index
+
+
+def get_indexed_tier_pricing(tier: str, location: str, price_index: dict, redundancy: str = "LRS"):
+    # Same as get_tier_pricing but with O(1) lookups in a price index built from the regional price sheets
+    sku_name = f"{tier} {redundancy}"
+    if tier.startswith("P"):
+        price = price_index.get(
+            (f"{tier} {redundancy} Disk", sku_name, location, "Consumption"))
+        if price is None:
+            print(f"Error no pricing found for tier {tier} in region {location}")
+        return price or 0, 0
+    price_fixed = price_index.get(
+        (f"{tier} Disks", sku_name, location, "Consumption"))
+    if price_fixed is None:
+        print(
+            f"Error no fixed pricing found for tier {tier} in region {location}")
+    price_variable = price_index.get(
+        ("Disk Operations", sku_name, location, "Consumption"))
+    if price_variable is None:
+        print(
+            f"Error no variable pricing found for tier {tier} in region {location}")
+    return price_fixed or 0, price_variable or 0
+
+
+def get_indexed_candidates_pricing(tiers: List[str], redundancies: List[str], locations: List[str], price_index: dict) -> tuple:
+    # Fixed and variable prices of every tier and redundancy (columns) in every location (rows), NaN where the region does not sell it
+    fixed_pricing = np.full((len(locations), len(tiers)), np.nan)
+    variable_pricing = np.full((len(locations), len(tiers)), np.nan)
+    for i, location in enumerate(locations):
+        for j, (tier, redundancy) in enumerate(zip(tiers, redundancies)):
+            sku_name = f"{tier} {redundancy}"
+            if tier.startswith("P"):
+                fixed_pricing[i, j] = price_index.get(
+                    (f"{tier} {redundancy} Disk", sku_name, location, "Consumption"), np.nan)
+                variable_pricing[i, j] = 0
+            else:
+                fixed_pricing[i, j] = price_index.get(
+                    (f"{tier} Disks", sku_name, location, "Consumption"), np.nan)
+                variable_pricing[i, j] = price_index.get(
+                    ("Disk Operations", sku_name, location, "Consumption"), np.nan)
+    return fixed_pricing, variable_pricing
+
+
+def get_indexed_premium_v2_pricing(locations: List[str], price_index: dict, redundancy: str = "LRS") -> np.ndarray:
+    # Monthly price of a provisioned GiB, IOPS and MB/s (columns) of Premium SSD v2 in every location (rows), NaN where not available
+    return np.array([[price_index.get((f"Premium {redundancy} {meter}", f"Premium {redundancy}", location, "Consumption"), np.nan)
+                      for meter in PREMIUM_V2_METERS] for location in locations], dtype=float).reshape(len(locations), len(PREMIUM_V2_METERS)) * HOURS_PER_MONTH
 
 
 def get_tier_pricing(tier: str, location: str, redundancy: str = "LRS"):
-    response = requests.get(
-        f"https://prices.azure.com/api/retail/prices?$filter={get_pricing_REST_filters(location, tier, redundancy)}")
+    import requests
+    response = request_with_retry(
+        requests, "GET", f"{PRICES_ENDPOINT}/api/retail/prices?$filter={get_pricing_REST_filters(location, tier, redundancy)}", max_retries=0, kind="prices")
     retail_prices = json.loads(response.content)
     try:
         retail_prices = retail_prices['Items']
@@ -60,6 +190,53 @@ def get_tier_pricing(tier: str, location: str, redundancy: str = "LRS"):
         return price_fixed, price_variable
 
 
+def estimate_costs(df: pd.DataFrame, tier_pricing_df: pd.DataFrame) -> pd.DataFrame:
+    # Price current and recommended tiers with one (tier, location) index lookup and column arithmetic
+    pricing = tier_pricing_df.drop_duplicates(
+        ["tier", "location"]).set_index(["tier", "location"])
+    # Unknown (tier, location) get position -1 which points to the appended NaN, as a left merge would
+    fixed_pricing = np.append(pricing.fixed_pricing.to_numpy(dtype=float), np.nan)
+    variable_pricing = np.append(
+        pricing.variable_pricing.to_numpy(dtype=float), np.nan)
+    current_positions = pricing.index.get_indexer(
+        pd.MultiIndex.from_arrays([df.current_tier, df.location]))
+    recommended_positions = pricing.index.get_indexer(
+        pd.MultiIndex.from_arrays([df.recommended_tier, df.location]))
+    monthly_operations = df.iops.to_numpy(
+        dtype=float) / OPERATIONS_BILLING_UNIT * HOURS_PER_MONTH * 3600
+    return pd.DataFrame({
+        "id": df.id.to_numpy(),
+        "current_tier": df.current_tier.to_numpy(),
+        "recommended_tier": df.recommended_tier.to_numpy(),
+        "location": df.location.to_numpy(),
+        "iops": df.iops.to_numpy(),
+        "current_fixed_pricing": fixed_pricing[current_positions],
+        "current_variable_pricing": variable_pricing[current_positions],
+        "recommended_fixed_pricing": fixed_pricing[recommended_positions],
+        "recommended_variable_pricing": variable_pricing[recommended_positions],
+        "estimated_current_variable_pricing": monthly_operations * variable_pricing[current_positions],
+        "estimated_recommended_variable_pricing": monthly_operations * variable_pricing[recommended_positions]
+    })
+
+
+def get_cost_summary(df: pd.DataFrame, PAYG_discount: float = 10**-15) -> dict:
+    if PAYG_discount < 0 or PAYG_discount > 1:
+        raise ValueError("PAYG discount must be a value between 0 and 1")
+    costs = {column: round(np.nansum(df[column].to_numpy(dtype=float)) * (1 - PAYG_discount), 2)
+             for column in COST_COLUMNS}
+    cost_summary = {
+        "fixed_current_cost": costs["current_fixed_pricing"],
+        "variable_current_cost": costs["estimated_current_variable_pricing"],
+        "fixed_projected_cost": costs["recommended_fixed_pricing"],
+        "variable_projected_cost": costs["estimated_recommended_variable_pricing"]
+    }
+    cost_summary["current_cost"] = cost_summary["fixed_current_cost"] + \
+        cost_summary["variable_current_cost"]
+    cost_summary["projected_cost"] = cost_summary["fixed_projected_cost"] + \
+        cost_summary["variable_projected_cost"]
+    return cost_summary
+
+
 def summarize(df: pd.DataFrame, save_csv: bool = True, csv_name: str = "disk_recommendations", fill: int = 150, PAYG_discount: float = 10**-15) -> None:
     if PAYG_discount < 0 or PAYG_discount > 1:
         raise ValueError("PAYG discount must be a value between 0 and 1")
@@ -69,18 +246,13 @@ def summarize(df: pd.DataFrame, save_csv: bool = True, csv_name: str = "disk_rec
             print(f"Saving recommendation results to {csv_path}.")
             csv_path.parent.mkdir(parents=True, exist_ok=True)
             df.to_csv(csv_path)
-    cost_agg_df = df.agg({'current_fixed_pricing': ['sum'], 'estimated_current_variable_pricing': [
-                         'sum'], 'recommended_fixed_pricing': ['sum'], 'estimated_recommended_variable_pricing': ['sum']})
-    fixed_current_cost = round(
-        cost_agg_df.current_fixed_pricing.iloc[0] * (1 - PAYG_discount), 2)
-    variable_current_cost = round(
-        cost_agg_df.estimated_current_variable_pricing.iloc[0] * (1 - PAYG_discount), 2)
-    fixed_projected_cost = round(
-        cost_agg_df.recommended_fixed_pricing.iloc[0] * (1 - PAYG_discount), 2)
-    variable_projected_cost = round(
-        cost_agg_df.estimated_recommended_variable_pricing.iloc[0] * (1 - PAYG_discount), 2)
-    current_cost = fixed_current_cost + variable_current_cost
-    projected_cost = fixed_projected_cost + variable_projected_cost
+    cost_summary = get_cost_summary(df, PAYG_discount=PAYG_discount)
+    fixed_current_cost = cost_summary["fixed_current_cost"]
+    variable_current_cost = cost_summary["variable_current_cost"]
+    fixed_projected_cost = cost_summary["fixed_projected_cost"]
+    variable_projected_cost = cost_summary["variable_projected_cost"]
+    current_cost = cost_summary["current_cost"]
+    projected_cost = cost_summary["projected_cost"]
     print("#"*fill)
     print("# DISCLAIMER: The cost estimates are based on the current pricing of the Azure services and are subject to change.".ljust(fill - 2), "#")
     print("# DISCLAIMER: The recommendations does not align with WAF Reliability as we do not take into account wanted SLAs for machines.".ljust(fill - 2), "#")
@@ -0,0 +1,192 @@
+import json
+import time
+import threading
+import pandas as pd
+from datetime import datetime, timezone
+from urllib.parse import urlsplit, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from modules.compute import get_list_disks_df, get_tiers, get_lower_recommended_tiers
+from modules.metrics import get_disks_throughput_IOPS_incremental, get_timespan
+from modules.metrics_cache import MetricsCache
+from modules.pricing import load_price_index, get_indexed_tier_pricing, estimate_costs, get_cost_summary
+from modules.instrumentation import run_report
+
+
+# A disk is evaluated again when one of these changes, e.g. after a resize or a SKU change
+INVENTORY_COLUMNS = ["sku_name", "disk_size_gb", "location"]
+METRICS_COLUMNS = ["throughput", "IOPS"]
+
+
+class DiskAnalysisService:
+    # Keeps inventory, metrics, prices and recommendations in memory and only re-evaluates disks whose inputs changed
+    def __init__(self, credential, subscription_client, tier_table: pd.DataFrame, metrics_cache: MetricsCache, interval_ISO: str = "PT1M", timerange_days: int = 3,
+                 max_workers_inventory: int = 8, max_workers_metrics: int = 16, batch_metrics: bool = False, use_resource_graph: bool = False,
+                 price_cache_ttl_hours: float = 24, minimal_tier: str = "STANDARD_HDD"):
+        self.credential = credential
+        self.subscription_client = subscription_client
+        self.tier_table = tier_table
+        self.metrics_cache = metrics_cache
+        self.interval_ISO = interval_ISO
+        self.timerange_days = timerange_days
+        self.max_workers_inventory = max_workers_inventory
+        self.max_workers_metrics = max_workers_metrics
+        self.batch_metrics = batch_metrics
+        self.use_resource_graph = use_resource_graph
+        self.price_cache_ttl_hours = price_cache_ttl_hours
+        self.minimal_tier = minimal_tier
+        self.disks_df = pd.DataFrame(columns=INVENTORY_COLUMNS)
+        self.metrics_df = pd.DataFrame(columns=METRICS_COLUMNS)
+        self.costs_df = pd.DataFrame()
+        self.price_index = {}
+        self.price_index_loaded_at = 0
+        self.price_index_locations = set()
+        self.tier_prices = {}
+        self.last_refresh = None
+        self._lock = threading.Lock()
+
+    def get_changed_disk_ids(self, disks_df: pd.DataFrame, metrics_df: pd.DataFrame) -> tuple:
+        removed = self.disks_df.index.difference(disks_df.index)
+        added = disks_df.index.difference(self.disks_df.index)
+        common = disks_df.index.intersection(self.disks_df.index)
+        # Compared as strings as categories and dtypes differ between inventory runs
+        inventory_changed = common[(disks_df.loc[common, INVENTORY_COLUMNS].astype(str) != self.disks_df.loc[common, INVENTORY_COLUMNS].astype(str)).any(axis=1).to_numpy()]
+        previous_metrics = self.metrics_df.reindex(common)[METRICS_COLUMNS]
+        metrics_changed = common[(metrics_df.reindex(common)[METRICS_COLUMNS] != previous_metrics).any(axis=1).to_numpy()]
+        return added, removed, inventory_changed.union(metrics_changed)
+
+    def load_prices(self, locations) -> bool:
+        # Returns True when the price index was (re)loaded, in which case every disk has to be priced again
+        if self.price_index and time.time() - self.price_index_loaded_at < self.price_cache_ttl_hours * 3600 and set(locations) <= self.price_index_locations:
+            return False
+        self.price_index = load_price_index(
+            list(locations), ttl_hours=self.price_cache_ttl_hours)
+        self.price_index_locations = set(locations)
+        self.price_index_loaded_at = time.time()
+        self.tier_prices = {}
+        return True
+
+    def evaluate(self, disks_df: pd.DataFrame, metrics_df: pd.DataFrame) -> pd.DataFrame:
+        metrics = metrics_df.reindex(disks_df.index)
+        current_tiers = get_tiers(
+            disks_df.disk_size_gb, disks_df.sku_name, self.tier_table)
+        disks_recommendation_df = pd.DataFrame({
+            "id": disks_df.index,
+            "current_tier": current_tiers,
+            "recommended_tier": get_lower_recommended_tiers(current_tiers, metrics.throughput, metrics.IOPS, self.tier_table, minimal_tier=self.minimal_tier),
+            "iops": metrics.IOPS.to_numpy(),
+            "location": disks_df.location.astype(str).to_numpy()
+        })
+        tier_locations = set(zip(disks_recommendation_df.current_tier, disks_recommendation_df.location)) | set(
+            zip(disks_recommendation_df.recommended_tier, disks_recommendation_df.location))
+        for tier, location in tier_locations - set(self.tier_prices):
+            self.tier_prices[(tier, location)] = get_indexed_tier_pricing(
+                tier, location, self.price_index, redundancy="LRS")
+        tier_pricing_df = pd.DataFrame([{"tier": tier, "location": location, "fixed_pricing": fixed_pricing, "variable_pricing": variable_pricing}
+                                        for (tier, location), (fixed_pricing, variable_pricing) in self.tier_prices.items()])
+        return estimate_costs(disks_recommendation_df, tier_pricing_df).set_index("id")
+
+    def refresh(self) -> dict:
+        with run_report.stage("inventory"):
+            disks_df = get_list_disks_df(self.credential, self.subscription_client, max_workers=self.max_workers_inventory,
+                                         use_resource_graph=self.use_resource_graph).set_index("id", drop=False)
+        with run_report.stage("metrics"):
+            # Only new metric windows are fetched, older ones come from the cache
+            metrics_df = pd.DataFrame(get_disks_throughput_IOPS_incremental(disks_df.id.tolist(), disks_df.location.astype(str).tolist(), self.credential, self.metrics_cache,
+                                                                            interval_ISO=self.interval_ISO, timerange_days=self.timerange_days, max_workers=self.max_workers_metrics, batch=self.batch_metrics)).set_index("id")
+            # Days before the window are never read again, dropping them keeps the cache from growing with every refresh
+            self.metrics_cache.prune(get_timespan(self.timerange_days)[0])
+        added, removed, changed = self.get_changed_disk_ids(
+            disks_df, metrics_df)
+        with run_report.stage("pricing"):
+            prices_reloaded = self.load_prices(
+                disks_df.location.astype(str).unique())
+        to_evaluate = disks_df.index if prices_reloaded else added.union(changed)
+        with run_report.stage("recommendations"):
+            costs_df = self.evaluate(
+                disks_df.loc[to_evaluate], metrics_df) if len(to_evaluate) else None
+        with self._lock:
+            kept_costs_df = self.costs_df.drop(index=removed.union(
+                to_evaluate), errors="ignore") if len(self.costs_df) else self.costs_df
+            self.costs_df = pd.concat([kept_costs_df, costs_df]) if costs_df is not None else kept_costs_df
+            self.disks_df = disks_df
+            self.metrics_df = metrics_df
+            self.last_refresh = datetime.now(timezone.utc).isoformat()
+        changes = {"added": len(added), "removed": len(removed), "changed": len(
+            changed), "evaluated": len(to_evaluate), "disks": len(disks_df)}
+        print(f"Refreshed at {self.last_refresh}: {changes}")
+        return changes
+
+    def get_summary(self, PAYG_discount: float = 0) -> dict:
+        with self._lock:
+            costs_df = self.costs_df
+            last_refresh = self.last_refresh
+        if not len(costs_df):
+            return {"last_refresh": last_refresh, "disks": 0}
+        return {"last_refresh": last_refresh, "disks": len(costs_df), "disks_with_recommendation": int((costs_df.current_tier != costs_df.recommended_tier).sum()),
+                "PAYG_discount": PAYG_discount, **get_cost_summary(costs_df, PAYG_discount=PAYG_discount)}
+
+    def get_recommendations_json(self, filters: dict) -> str:
+        with self._lock:
+            costs_df = self.costs_df
+        if not len(costs_df):
+            return "[]"
+        mask = pd.Series(True, index=costs_df.index)
+        for column in ("location", "current_tier", "recommended_tier"):
+            if column in filters:
+                mask &= costs_df[column] == filters[column]
+        if filters.get("changes_only", "false").lower() == "true":
+            mask &= costs_df.current_tier != costs_df.recommended_tier
+        return costs_df[mask].reset_index().to_json(orient="records")
+
+
+def get_handler(service: DiskAnalysisService):
+    class ServiceHandler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def send_content(self, status: int, content: str):
+            body = content.encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            url = urlsplit(self.path)
+            query = {key: values[0]
+                     for key, values in parse_qs(url.query).items()}
+            try:
+                if url.path == "/summary":
+                    return self.send_content(200, json.dumps(service.get_summary(PAYG_discount=float(query.get("PAYG_discount", 0)))))
+                if url.path == "/recommendations":
+                    return self.send_content(200, service.get_recommendations_json(query))
+                if url.path == "/health":
+                    return self.send_content(200, json.dumps({"last_refresh": service.last_refresh}))
+            except ValueError as e:
+                return self.send_content(400, json.dumps({"error": str(e)}))
+            self.send_content(404, json.dumps(
+                {"error": f"{url.path} not found, available: /summary, /recommendations, /health"}))
+
+    return ServiceHandler
+
+
+def serve(service: DiskAnalysisService, port: int = 8080, poll_interval_minutes: float = 60) -> None:
+    # Answers requests from a background thread while the main thread refreshes the data periodically
+    server = ThreadingHTTPServer(("127.0.0.1", port), get_handler(service))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(
+        f"Serving recommendations on http://127.0.0.1:{port} (/summary, /recommendations, /health).")
+    try:
+        while True:
+            try:
+                service.refresh()
+            except Exception as err:
+                # Keep serving the last recommendations, the next poll tries again
+                print(f"Error occurred refreshing recommendations: {err}")
+            time.sleep(poll_interval_minutes * 60)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
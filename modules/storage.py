@@ -0,0 +1,101 @@
+import json
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from typing import Iterable, List
+from pathlib import Path
+
+
+# Bumped whenever the columns of a table change, tables written with another version are not reused
+SCHEMA_VERSION = 1
+DATA_DIR = "data"
+# Columns holding dicts or lists, stored as JSON strings
+JSON_COLUMNS = ["tags", "managed_by_extended"]
+# Rows are sorted by these columns (when present) so that row group statistics let filters skip most of the file
+SORT_COLUMNS = ["subscription_id", "location"]
+ROW_GROUP_SIZE = 65536
+
+
+def get_table_path(name: str, data_dir: str = DATA_DIR) -> Path:
+    return Path(data_dir) / f"{name}.parquet"
+
+
+def table_exists(name: str, data_dir: str = DATA_DIR) -> bool:
+    path = get_table_path(name, data_dir)
+    if not path.is_file():
+        return False
+    metadata = pq.read_schema(path).metadata or {}
+    if metadata.get(b"schema_version") != str(SCHEMA_VERSION).encode():
+        print(
+            f"Ignoring {path} written with schema version {metadata.get(b'schema_version', b'unknown').decode()} instead of {SCHEMA_VERSION}.")
+        return False
+    return True
+
+
+def get_table_metadata(name: str) -> dict:
+    return {b"schema_version": str(SCHEMA_VERSION).encode(), b"table": name.encode()}
+
+
+def get_arrow_table(df: pd.DataFrame, name: str, schema: pa.Schema = None) -> pa.Table:
+    df = df.copy()
+    for column in JSON_COLUMNS:
+        if column in df.columns:
+            df[column] = [None if value is None else json.dumps(
+                value) for value in df[column]]
+    sort_columns = [column for column in SORT_COLUMNS if column in df.columns]
+    if sort_columns:
+        df = df.sort_values(sort_columns, kind="stable")
+    table = pa.Table.from_pandas(df, schema=schema, preserve_index=False)
+    return table.replace_schema_metadata({**(table.schema.metadata or {}), **get_table_metadata(name)})
+
+
+def get_tmp_path(path: Path) -> Path:
+    # Tables are written next to their path then renamed, so that an interrupted write never leaves a truncated table
+    path.parent.mkdir(parents=True, exist_ok=True)
+    return path.with_suffix(".parquet.tmp")
+
+
+def write_table(df: pd.DataFrame, name: str, data_dir: str = DATA_DIR) -> None:
+    path = get_table_path(name, data_dir)
+    tmp_path = get_tmp_path(path)
+    pq.write_table(get_arrow_table(df, name), tmp_path, row_group_size=ROW_GROUP_SIZE)
+    tmp_path.replace(path)
+
+
+def write_table_chunks(chunks: Iterable[pd.DataFrame], name: str, schema: pa.Schema, data_dir: str = DATA_DIR) -> int:
+    # Chunks are buffered up to a row group, which is sorted and written before the next chunks are read, so that memory is bounded by a row group
+    # instead of the whole table. Every chunk is cast to schema. Returns the number of rows written
+    path = get_table_path(name, data_dir)
+    tmp_path = get_tmp_path(path)
+    n_rows = 0
+    try:
+        with pq.ParquetWriter(tmp_path, schema.with_metadata(get_table_metadata(name))) as writer:
+            buffer, buffered_rows = [], 0
+            for chunk in chunks:
+                buffer.append(chunk)
+                buffered_rows += len(chunk)
+                if buffered_rows >= ROW_GROUP_SIZE:
+                    writer.write_table(get_arrow_table(pd.concat(buffer, ignore_index=True), name, schema))
+                    n_rows += buffered_rows
+                    buffer, buffered_rows = [], 0
+            if buffer:
+                writer.write_table(get_arrow_table(pd.concat(buffer, ignore_index=True), name, schema))
+                n_rows += buffered_rows
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    tmp_path.replace(path)
+    return n_rows
+
+
+def read_table(name: str, columns: List[str] = None, filters: List[tuple] = None, data_dir: str = DATA_DIR) -> pd.DataFrame:
+    # Only the requested columns are read, and row groups not matching the filters (pyarrow DNF, e.g. [("location", "==", "westeurope")]) are skipped
+    table = pq.read_table(get_table_path(name, data_dir), columns=columns,
+                          filters=filters or None, memory_map=True)
+    df = table.to_pandas()
+    for column in JSON_COLUMNS:
+        if column in df.columns:
+            # Missing values are read back as None or NaN depending on the pandas string dtype
+            df[column] = [json.loads(value) if isinstance(
+                value, str) else None for value in df[column]]
+    return df.reset_index(drop=True)
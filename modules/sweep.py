@@ -0,0 +1,157 @@
+import itertools
+import numpy as np
+import pandas as pd
+from typing import List, NamedTuple
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
+from modules.compute import get_tier_table, get_tiers, get_lower_recommended_tiers, get_policy_columns
+from modules.pricing import estimate_costs, get_cost_summary, get_indexed_candidates_pricing, load_price_index
+from modules.timeseries import TimeseriesStore, get_timeseries_stats
+from modules.storage import read_table
+
+
+class Scenario(NamedTuple):
+    # timerange_days None uses the whole stored time series, shorter ranges use its last days
+    PAYG_discount: float = 0
+    timerange_days: float = None
+    sizing_policy: str = "max"
+    minimal_tier: str = "STANDARD_HDD"
+
+
+# Arrays of the sweep inputs placed in shared memory, attached by every worker instead of being pickled per scenario
+SHARED_ARRAYS = ["throughput", "IOPS", "current_tier_codes", "location_codes"]
+
+# Inputs attached by the current worker process, and statistics already computed per time range
+_worker = {}
+
+
+def get_scenarios(PAYG_discounts: List[float] = (0,), timerange_days: List[float] = (None,), sizing_policies: List[str] = ("max",),
+                  minimal_tiers: List[str] = ("STANDARD_HDD",)) -> List[Scenario]:
+    # Every combination of the given values
+    return [Scenario(*values) for values in itertools.product(PAYG_discounts, timerange_days, sizing_policies, minimal_tiers)]
+
+
+def get_tier_pricing_df(tier_table: pd.DataFrame, locations: List[str], price_index: dict) -> pd.DataFrame:
+    # LRS prices of every tier in every location, as load_tier_pricing_df would get them for the tiers it needs
+    tiers = tier_table.index.tolist()
+    fixed_pricing, variable_pricing = get_indexed_candidates_pricing(
+        tiers, ["LRS"] * len(tiers), locations, price_index)
+    return pd.DataFrame({
+        "tier": np.tile(tiers, len(locations)),
+        "location": np.repeat(locations, len(tiers)),
+        "fixed_pricing": np.nan_to_num(fixed_pricing.ravel()),
+        "variable_pricing": np.nan_to_num(variable_pricing.ravel())
+    })
+
+
+def load_sweep_inputs(timeseries_store: str, disk_skus: dict, data_dir: str = "data", price_cache_dir: str = "data/prices", price_cache_ttl_hours: float = 24) -> dict:
+    # Saved disks table and time series of a previous run, aligned on the disks of the series, and prices of all tiers in their regions
+    metadata, throughput, IOPS = TimeseriesStore(timeseries_store).load()
+    disks_df = read_table("disks", columns=["id", "location", "sku_name", "disk_size_gb"], data_dir=data_dir).set_index(
+        "id").reindex(metadata["disk_ids"])
+    if disks_df.sku_name.isna().any():
+        raise ValueError(
+            f"{disks_df.sku_name.isna().sum()} disks of the time series are missing from the saved disks table.")
+    tier_table = get_tier_table(disk_skus)
+    locations = sorted(disks_df.location.astype(str).unique())
+    price_index = load_price_index(
+        locations, cache_dir=price_cache_dir, ttl_hours=price_cache_ttl_hours)
+    return {
+        "disks_df": disks_df.reset_index(),
+        "throughput": throughput,
+        "IOPS": IOPS,
+        "interval_seconds": metadata["interval_seconds"],
+        "tier_table": tier_table,
+        "tier_pricing_df": get_tier_pricing_df(tier_table, locations, price_index)
+    }
+
+
+def init_worker(shared_blocks: dict, context: dict) -> None:
+    for name, (block_name, shape, dtype) in shared_blocks.items():
+        block = shared_memory.SharedMemory(name=block_name)
+        _worker.setdefault("blocks", []).append(block)
+        _worker[name] = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+    _worker.update(context)
+    _worker["stats"] = {}
+
+
+def get_window_stats(timerange_days: float) -> dict:
+    # Statistics of the last timerange_days of the series, computed once per worker and time range
+    if timerange_days not in _worker["stats"]:
+        n_points = _worker["throughput"].shape[1]
+        window = n_points if timerange_days is None else int(
+            np.ceil(timerange_days * 86400 / _worker["interval_seconds"]))
+        if window > n_points:
+            raise ValueError(
+                f"timerange_days {timerange_days} is longer than the {n_points * _worker['interval_seconds'] / 86400:g} days of stored time series.")
+        _worker["stats"][timerange_days] = get_timeseries_stats(
+            _worker["throughput"][:, n_points - window:], _worker["IOPS"][:, n_points - window:])
+    return _worker["stats"][timerange_days]
+
+
+def evaluate_scenarios(timerange_days: float, sizing_policy: str, minimal_tier: str, PAYG_discounts: List[float]) -> List[dict]:
+    # Recommendations only depend on the time range, policy and minimal tier, the discounts are applied to the same costs
+    stats = get_window_stats(timerange_days)
+    throughput_column, IOPS_column = get_policy_columns(sizing_policy)
+    tier_names = _worker["tier_table"].index.to_numpy()
+    current_tiers = tier_names[_worker["current_tier_codes"]]
+    recommended_tiers = get_lower_recommended_tiers(
+        current_tiers, stats[throughput_column], stats[IOPS_column], _worker["tier_table"], minimal_tier=minimal_tier)
+    costs_df = estimate_costs(pd.DataFrame({
+        "id": np.arange(len(current_tiers)),
+        "current_tier": current_tiers,
+        "recommended_tier": recommended_tiers,
+        "iops": stats["IOPS"],
+        "location": _worker["locations"][_worker["location_codes"]]
+    }), _worker["tier_pricing_df"])
+    disks_with_recommendation = int((current_tiers != recommended_tiers).sum())
+    return [{"PAYG_discount": PAYG_discount, "timerange_days": timerange_days, "sizing_policy": sizing_policy, "minimal_tier": minimal_tier,
+             "disks_with_recommendation": disks_with_recommendation, **get_cost_summary(costs_df, PAYG_discount=PAYG_discount)} for PAYG_discount in PAYG_discounts]
+
+
+def run_sweep(scenarios: List[Scenario], disks_df: pd.DataFrame, throughput: np.ndarray, IOPS: np.ndarray, interval_seconds: int, tier_table: pd.DataFrame,
+              tier_pricing_df: pd.DataFrame, max_workers: int = None) -> pd.DataFrame:
+    # Current versus projected fixed and variable costs of every scenario (one row each), evaluated over a process pool.
+    # disks_df (id, location, sku_name, disk_size_gb) rows are the rows of the throughput and IOPS series, as returned by load_sweep_inputs
+    for scenario in scenarios:
+        get_policy_columns(scenario.sizing_policy)
+        if scenario.PAYG_discount < 0 or scenario.PAYG_discount > 1:
+            raise ValueError("PAYG discount must be a value between 0 and 1")
+    locations = pd.Categorical(disks_df.location.astype(str))
+    arrays = {
+        "throughput": np.asarray(throughput, dtype=np.float32),
+        "IOPS": np.asarray(IOPS, dtype=np.float32),
+        "current_tier_codes": pd.Categorical(get_tiers(disks_df.disk_size_gb, disks_df.sku_name, tier_table), categories=tier_table.index).codes.astype(np.int64),
+        "location_codes": locations.codes.astype(np.int64)
+    }
+    context = {"interval_seconds": interval_seconds, "tier_table": tier_table,
+               "tier_pricing_df": tier_pricing_df, "locations": np.asarray(locations.categories, dtype=object)}
+    # Scenarios sharing time range, policy and minimal tier are evaluated by one task
+    groups = {}
+    for scenario in scenarios:
+        groups.setdefault((scenario.timerange_days, scenario.sizing_policy,
+                          scenario.minimal_tier), []).append(scenario.PAYG_discount)
+    blocks = []
+    try:
+        shared_blocks = {}
+        for name in SHARED_ARRAYS:
+            array = arrays[name]
+            block = shared_memory.SharedMemory(
+                create=True, size=max(array.nbytes, 1))
+            blocks.append(block)
+            np.ndarray(array.shape, dtype=array.dtype,
+                       buffer=block.buf)[...] = array
+            shared_blocks[name] = (block.name, array.shape, array.dtype.str)
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=init_worker, initargs=(shared_blocks, context)) as executor:
+            futures = [executor.submit(evaluate_scenarios, *group, PAYG_discounts)
+                       for group, PAYG_discounts in groups.items()]
+            results = {Scenario(result["PAYG_discount"], result["timerange_days"], result["sizing_policy"], result["minimal_tier"]): result
+                       for future in futures for result in future.result()}
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+    results_df = pd.DataFrame([results[scenario] for scenario in scenarios], columns=[*Scenario._fields, "disks_with_recommendation", "fixed_current_cost", "variable_current_cost",
+                                                "fixed_projected_cost", "variable_projected_cost", "current_cost", "projected_cost"])
+    results_df["savings"] = results_df.current_cost - results_df.projected_cost
+    return results_df
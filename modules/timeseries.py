@@ -0,0 +1,147 @@
+import json
+import numpy as np
+import pandas as pd
+from typing import List
+from pathlib import Path
+
+
+PERCENTILES = (50, 95, 99)
+# Rows of disks processed at once when computing statistics, to bound memory on memory-mapped series
+STATS_CHUNK_SIZE = 4096
+
+
+def get_interval_seconds(interval_ISO: str) -> int:
+    return int(pd.Timedelta(interval_ISO).total_seconds())
+
+
+def get_window_points(timerange_days: float, interval_seconds: int) -> int:
+    # Points of the last timerange_days at interval_seconds, as many as get_disks_timeseries collects for that range
+    return int(timerange_days * 86400 // interval_seconds)
+
+
+def parse_disk_timeseries(metrics: dict, start_date: str, interval_seconds: int, n_points: int) -> tuple:
+    # Throughput (MB/s) and IOPS per point of the time grid, read and write maxima being summed, NaN where no data
+    series = {}
+    start = np.datetime64(start_date[:19], "s")
+    for metric in metrics["value"]:
+        values = np.full(n_points, np.nan, dtype=np.float32)
+        for timeseries in metric["timeseries"]:
+            points = [(point["timeStamp"][:19], point["maximum"]) for point in timeseries.get(
+                "data", []) if point.get("maximum") is not None]
+            if not points:
+                continue
+            timestamps, maxima = zip(*points)
+            positions = (np.array(timestamps, dtype="datetime64[s]") -
+                         start).astype(np.int64) // interval_seconds
+            in_range = (positions >= 0) & (positions < n_points)
+            values[positions[in_range]] = np.array(
+                maxima, dtype=np.float32)[in_range]
+        series[metric["name"]["value"]] = values
+    empty = np.full(n_points, np.nan, dtype=np.float32)
+    throughput = sum_series(series.get("Composite Disk Read Bytes/sec", empty),
+                            series.get("Composite Disk Write Bytes/sec", empty)) / (1024 * 1024)
+    IOPS = sum_series(series.get("Composite Disk Read Operations/sec", empty),
+                      series.get("Composite Disk Write Operations/sec", empty))
+    return throughput, IOPS
+
+
+def sum_series(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    # NaN only where both series have no data
+    return np.where(np.isnan(a) & np.isnan(b), np.nan, np.nan_to_num(a) + np.nan_to_num(b)).astype(np.float32)
+
+
+class TimeseriesStore:
+    # Per disk throughput and IOPS series as float32 (disks x points) .npy files, memory-mapped on read
+    def __init__(self, path: str):
+        self.path = Path(path)
+
+    def exists(self) -> bool:
+        return (self.path / "metadata.json").is_file()
+
+    def create(self, disk_ids: List[str], start_date: str, interval_seconds: int, n_points: int) -> tuple:
+        self.path.mkdir(parents=True, exist_ok=True)
+        # Metadata is written last by close, so an interrupted collection is not mistaken for a complete store
+        (self.path / "metadata.json").unlink(missing_ok=True)
+        self.metadata = {"disk_ids": disk_ids, "start_date": start_date,
+                         "interval_seconds": interval_seconds, "n_points": n_points}
+        self.throughput, self.IOPS = [np.lib.format.open_memmap(self.path / f"{name}.npy", mode="w+", dtype=np.float32, shape=(
+            len(disk_ids), n_points)) for name in ("throughput", "IOPS")]
+        self.throughput[:] = np.nan
+        self.IOPS[:] = np.nan
+        return self.throughput, self.IOPS
+
+    def close(self) -> None:
+        self.throughput.flush()
+        self.IOPS.flush()
+        with open(self.path / "metadata.json", "w") as f:
+            json.dump(self.metadata, f)
+
+    def load(self) -> tuple:
+        with open(self.path / "metadata.json", "r") as f:
+            self.metadata = json.load(f)
+        self.throughput, self.IOPS = [np.load(
+            self.path / f"{name}.npy", mmap_mode="r") for name in ("throughput", "IOPS")]
+        return self.metadata, self.throughput, self.IOPS
+
+    def covers(self, timerange_days: float, interval_seconds: int) -> bool:
+        # Whether the store was collected at interval_seconds over at least timerange_days
+        metadata = self.load()[0]
+        return metadata["interval_seconds"] == interval_seconds and get_window_points(timerange_days, interval_seconds) <= metadata["n_points"]
+
+    def load_window(self, timerange_days: float) -> tuple:
+        # Last timerange_days of the series (views of the memory-mapped files), the store may span a longer collection
+        metadata, throughput, IOPS = self.load()
+        start = max(metadata["n_points"] - get_window_points(timerange_days, metadata["interval_seconds"]), 0)
+        return metadata, throughput[:, start:], IOPS[:, start:]
+
+
+def get_timeseries_stats(throughput: np.ndarray, IOPS: np.ndarray, percentiles: tuple = PERCENTILES) -> dict:
+    # Maximum and percentiles of every disk, vectorized over chunks of rows, disks without data get 0
+    stats = {f"{metric}{suffix}": np.zeros(len(throughput)) for metric in (
+        "throughput", "IOPS") for suffix in ["", *[f"_p{percentile}" for percentile in percentiles]]}
+    for start in range(0, len(throughput), STATS_CHUNK_SIZE):
+        rows = slice(start, start + STATS_CHUNK_SIZE)
+        for metric, series in (("throughput", throughput), ("IOPS", IOPS)):
+            chunk = np.asarray(series[rows], dtype=np.float32)
+            has_data = ~np.isnan(chunk).all(axis=1)
+            if not has_data.any():
+                continue
+            chunk = chunk[has_data]
+            positions = np.arange(start, min(
+                start + STATS_CHUNK_SIZE, len(throughput)))[has_data]
+            stats[metric][positions] = np.nanmax(chunk, axis=1)
+            for percentile, values in zip(percentiles, np.nanpercentile(chunk, percentiles, axis=1)):
+                stats[f"{metric}_p{percentile}"][positions] = values
+    return stats
+
+
+def get_sustained_minutes(series: np.ndarray, thresholds: np.ndarray, interval_seconds: int) -> tuple:
+    # Longest run and total duration (in minutes) above each disk threshold, for all disks at once
+    over = np.asarray(series) > np.asarray(thresholds, dtype=np.float32)[:, None]
+    counts = np.cumsum(over, axis=1)
+    # Count reached at the last point under the threshold, subtracted to restart the run count after it
+    resets = np.maximum.accumulate(np.where(over, 0, counts), axis=1)
+    longest_runs = (counts - resets).max(axis=1, initial=0)
+    return longest_runs * interval_seconds / 60, counts[:, -1] * interval_seconds / 60 if counts.shape[1] else np.zeros(len(counts))
+
+
+def get_sustained_minutes_over_limits(throughput: np.ndarray, IOPS: np.ndarray, positions: np.ndarray, throughput_limits: np.ndarray, IOPS_limits: np.ndarray,
+                                      interval_seconds: int) -> tuple:
+    # Longest run and total minutes where throughput or IOPS of the disks at positions (rows of the series) is above their limits,
+    # over chunks of disks, NaN for disks without series (position -1)
+    positions = np.asarray(positions)
+    longest_runs = np.full(len(positions), np.nan)
+    totals = np.full(len(positions), np.nan)
+    throughput_limits = np.asarray(throughput_limits, dtype=np.float32)
+    IOPS_limits = np.asarray(IOPS_limits, dtype=np.float32)
+    for start in range(0, len(positions), STATS_CHUNK_SIZE):
+        chunk = np.arange(start, min(start + STATS_CHUNK_SIZE, len(positions)))
+        chunk = chunk[positions[chunk] >= 0]
+        if not len(chunk):
+            continue
+        # Load relative to the limits, above 1 when either limit is exceeded
+        load = np.fmax(np.asarray(throughput[positions[chunk]]) / throughput_limits[chunk, None],
+                       np.asarray(IOPS[positions[chunk]]) / IOPS_limits[chunk, None])
+        longest_runs[chunk], totals[chunk] = get_sustained_minutes(
+            load, np.ones(len(chunk)), interval_seconds)
+    return longest_runs, totals